@@ -1,110 +1,810 @@
-from collections import defaultdict
+import argparse
+import asyncio
+from collections import Counter, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 from email.utils import parseaddr
+import csv
 import datetime
+import io
+import json
+import logging
+from logging.handlers import RotatingFileHandler
 from email.mime.text import MIMEText
 import math
 import os
+import random
 import re
 from pytz import timezone, all_timezones
 import smtplib
+import sys
+import threading
+import time
+import traceback
+import uuid
+import weakref
 
 import dateparser
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+import numpy as np
 import psycopg2
 from psycopg2 import sql
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
-from telegram.error import BadRequest
-
-TOKEN = os.environ.get('BOT_TOKEN', None)
-if TOKEN is None:
-    raise Exception('No Token!')
-
-UPDATER = Updater(token=TOKEN)
-DISPATCHER = UPDATER.dispatcher
-JOBQUEUE = UPDATER.job_queue
-
-CONNECTION = None
+from telegram import Update
+from telegram.ext import Updater, CommandHandler, MessageHandler, TypeHandler, Filters
+from telegram.error import BadRequest, Unauthorized
+
+# Several communities can share one process: BOT_TOKENS="mindful=<token>,runners=<token>" runs a bot per token,
+# each keeping its data in the Postgres schema named after it. With just BOT_TOKEN everything stays in public.
+BOT_TOKENS = os.environ.get('BOT_TOKENS', None)
+DEFAULT_TENANT = 'public'
+
+# Lets the bot talk to something other than api.telegram.org, eg. the fake server in loadtest.py
+BOT_API_URL = os.environ.get('BOT_API_URL', None)
+
+# One connection per thread, so the dispatcher, the job queue and the async runtime's executors never
+# interleave statements in each other's transactions. With several tenants, each Updater's threads have their
+# own connections too, only the async runtime's pool is shared between tenants.
+CONNECTIONS = threading.local()
 DB_NAME = os.environ.get('DB_NAME', 'zenirlbot')
 DB_USER = os.environ.get('DB_USER', 'postgres')
 DB_PASSWORD = os.environ.get('DB_PASSWORD', 'password')
 DB_HOST = os.environ.get('DB_HOST', 'localhost')
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', 5))
+# Writes slower than this are cancelled and spooled to disk instead, the lookups
+# around a logging command get the same budget so the user is never kept waiting
+DB_WRITE_TIMEOUT_MS = int(os.environ.get('DB_WRITE_TIMEOUT_MS', 2000))
+# Errors meaning the database is down or too slow, rather than that we sent it something wrong
+DB_UNAVAILABLE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+# Run the command handlers that do the most I/O as coroutines on an asyncio loop instead of on the dispatcher thread
+ASYNC_MODE = os.environ.get('ASYNC_MODE', '').lower() in ('1', 'true', 'yes')
+ASYNC_DB_POOL_SIZE = int(os.environ.get('ASYNC_DB_POOL_SIZE', 10))
+ASYNC_IO_WORKERS = int(os.environ.get('ASYNC_IO_WORKERS', 16))
+ASYNC_CPU_WORKERS = int(os.environ.get('ASYNC_CPU_WORKERS', 2))
+
+SPOOL_PATH = os.environ.get('SPOOL_PATH', './write-spool.jsonl')
+SPOOL_REPLAY_INTERVAL = int(os.environ.get('SPOOL_REPLAY_INTERVAL', 30))
+
+# Telegram bots can only download files up to 20MB
+IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', 20 * 1024 * 1024))
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 10000))
 
 GMAIL_EMAIL = os.environ.get('GMAIL_EMAIL', None)
 GMAIL_PASSWORD = os.environ.get('GMAIL_PASSWORD', None)
 
+# Token buckets for admission control, refill rates are in tokens per second
+ADMISSION_USER_CAPACITY = float(os.environ.get('ADMISSION_USER_CAPACITY', 20))
+ADMISSION_USER_REFILL = float(os.environ.get('ADMISSION_USER_REFILL', 1 / 6))
+ADMISSION_CHAT_CAPACITY = float(os.environ.get('ADMISSION_CHAT_CAPACITY', 100))
+ADMISSION_CHAT_REFILL = float(os.environ.get('ADMISSION_CHAT_REFILL', 1))
+ADMISSION_NOTICE_INTERVAL = 60
+# Threads for the expensive commands outside ASYNC_MODE, so the dispatcher keeps reading updates meanwhile
+EXPENSIVE_WORKERS = int(os.environ.get('EXPENSIVE_WORKERS', 4))
+
+# Statements taking longer than SLOW_QUERY_MS are written to a rotating log, SLOW_QUERY_EXPLAIN_RATE of them with their plan
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+SLOW_QUERY_EXPLAIN_RATE = float(os.environ.get('SLOW_QUERY_EXPLAIN_RATE', 0.1))
+SLOW_QUERY_LOG_PATH = os.environ.get('SLOW_QUERY_LOG_PATH', './slow-queries.log')
+SLOW_QUERY_LOG_BYTES = 10 * 1024 * 1024
+SLOW_QUERY_LOG_BACKUPS = 5
+
+SLOW_QUERY_LOG = logging.getLogger('zenafbot.slowqueries')
+SLOW_QUERY_LOG.setLevel(logging.INFO)
+SLOW_QUERY_LOG.propagate = False
+SLOW_QUERY_HANDLER = RotatingFileHandler(SLOW_QUERY_LOG_PATH, maxBytes=SLOW_QUERY_LOG_BYTES, backupCount=SLOW_QUERY_LOG_BACKUPS,
+                                         encoding='utf-8', delay=True)
+SLOW_QUERY_HANDLER.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+SLOW_QUERY_LOG.addHandler(SLOW_QUERY_HANDLER)
+
+def get_tenant():
+    # Coroutines all share the loop's thread, so they keep their tenant on their task instead
+    if AIO_THREAD is not None and threading.current_thread() is AIO_THREAD:
+        task = current_task(AIO_LOOP)
+        return TASK_TENANTS[task] if task in TASK_TENANTS else DEFAULT_TENANT
+    return getattr(CONNECTIONS, 'tenant', DEFAULT_TENANT)
+
+def use_tenant(tenant):
+    CONNECTIONS.tenant = tenant
+
 def get_connection():
-    global CONNECTION
+    conn = getattr(CONNECTIONS, 'conn', None)
 
-    if not CONNECTION or CONNECTION.closed != 0:
-        CONNECTION = psycopg2.connect(
+    if not conn or conn.closed != 0:
+        conn = CONNECTIONS.conn = psycopg2.connect(
             dbname=DB_NAME,
             user=DB_USER,
             password=DB_PASSWORD,
             host=DB_HOST,
-            port="5432"
+            port="5432",
+            connect_timeout=DB_CONNECT_TIMEOUT,
+            cursor_factory=TimedCursor
         )
+        CONNECTIONS.search_path = None
+
+    # Each tenant's dispatcher has its own thread, but the async runtime's executors serve every tenant,
+    # so the schema is switched between transactions when a thread moves on to another tenant
+    tenant = get_tenant()
+    if CONNECTIONS.search_path != tenant:
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        cursor = conn.cursor()
+        cursor.execute(sql.SQL("SET search_path TO {}").format(sql.Identifier(tenant)))
+        conn.commit()
+        cursor.close()
+        CONNECTIONS.search_path = tenant
 
-    return CONNECTION
+    return conn
 
-def get_streak_of(user_id):
+def rollback_connection():
+    # Leave the connection usable after a failed or cancelled statement
+    conn = getattr(CONNECTIONS, 'conn', None)
+    try:
+        if conn and conn.closed == 0:
+            conn.rollback()
+    except psycopg2.Error:
+        pass
+
+class TimedCursor(psycopg2.extensions.cursor):
+    # Every statement on the sync connections is timed, see check_slow_query
+    def execute(self, query, params=None):
+        started = time.perf_counter()
+        try:
+            super().execute(query, params)
+        except psycopg2.Error as e:
+            check_slow_query(self.connection, query, params, started, error=e)
+            raise
+        check_slow_query(self.connection, query, params, started, self.rowcount)
+
+    def copy_expert(self, query, file, size=8192):
+        started = time.perf_counter()
+        try:
+            super().copy_expert(query, file, size)
+        except psycopg2.Error as e:
+            check_slow_query(self.connection, query, None, started, error=e)
+            raise
+        check_slow_query(self.connection, query, None, started, self.rowcount)
+
+def check_slow_query(conn, query, params, started, rowcount=-1, error=None):
+    duration_ms = (time.perf_counter() - started) * 1000
+    if duration_ms < SLOW_QUERY_MS:
+        return
+    if not isinstance(query, sql.Composable):
+        query = sql.SQL(query)
+    query_text = query.as_string(conn)
+    plan = None
+    explain = explain_query(query, query_text)
+    if error is None and explain is not None and random.random() < SLOW_QUERY_EXPLAIN_RATE:
+        # A plain cursor inside a savepoint, so the caller's results and transaction are left as they were
+        cursor = psycopg2.extensions.cursor(conn)
+        try:
+            cursor.execute("SAVEPOINT slow_query_explain")
+            cursor.execute(explain, params)
+            plan = [row[0] for row in cursor.fetchall()]
+            cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+        except psycopg2.Error as e:
+            plan = ["EXPLAIN failed: {}".format(e)]
+            if conn.closed == 0:
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+        finally:
+            cursor.close()
+    log_slow_query(query_text, params, duration_ms, rowcount, plan, error)
+
+def explain_query(query, query_text):
+    # EXPLAIN ANALYZE runs the statement again, so writes only get the planner's estimates
+    verb = query_text.lstrip().split(None, 1)[0].upper() if query_text.strip() else ""
+    if verb in ("SELECT", "WITH"):
+        return sql.SQL("EXPLAIN (ANALYZE, BUFFERS) {}").format(query)
+    if verb in ("INSERT", "UPDATE", "DELETE"):
+        return sql.SQL("EXPLAIN {}").format(query)
+    return None
+
+def redact_params(query_text, params):
+    # Journal entries are private, only their length goes in the log
+    if not params or not re.search(r'\bjournal\b', query_text):
+        return params
+    return tuple("<{} characters>".format(len(param)) if isinstance(param, str) else param for param in params)
+
+def log_slow_query(query_text, params, duration_ms, rowcount, plan=None, error=None):
+    lines = ["{:.1f}ms, {} rows, tenant {}".format(duration_ms, rowcount, get_tenant())]
+    lines.append("SQL: " + " ".join(query_text.split()))
+    if params is not None:
+        lines.append("Params: {!r}".format(redact_params(query_text, params)))
+    if error is not None:
+        lines.append("Error: {}".format(str(error).strip()))
+    if plan:
+        lines.append("Plan:")
+        lines.extend("    " + line for line in plan)
+    SLOW_QUERY_LOG.info("\n".join(lines))
+
+STREAK_QUERY = sql.SQL(
+    "WITH t AS ("\
+        "SELECT distinct(meditation.created_at::date) AS created_at "\
+        "FROM meditation "\
+        "WHERE id = %s"\
+    ")"\
+    "SELECT COUNT(*) FROM t WHERE t.created_at > ("\
+        "SELECT d.d "\
+        "FROM generate_series('2018-01-01'::date, TIMESTAMP 'yesterday'::date, '1 day') d(d) "\
+        "LEFT OUTER JOIN t ON t.created_at = d.d::date "\
+        "WHERE t.created_at IS NULL "\
+        "ORDER BY d.d DESC "\
+        "LIMIT 1"\
+    ")"
+)
+
+def set_statement_timeout(cursor, timeout_ms):
+    # Only lasts until the end of the current transaction
+    if timeout_ms:
+        cursor.execute("SET LOCAL statement_timeout = %s", (timeout_ms,))
+
+def get_streak_of(user_id, timeout_ms=None):
     cursor = get_connection().cursor()
-    cursor.execute(
-        sql.SQL(
-            "WITH t AS ("\
-                "SELECT distinct(meditation.created_at::date) AS created_at "\
-                "FROM meditation "\
-                "WHERE id = %s"\
-            ")"\
-            "SELECT COUNT(*) FROM t WHERE t.created_at > ("\
-                "SELECT d.d "\
-                "FROM generate_series('2018-01-01'::date, TIMESTAMP 'yesterday'::date, '1 day') d(d) "\
-                "LEFT OUTER JOIN t ON t.created_at = d.d::date "\
-                "WHERE t.created_at IS NULL "\
-                "ORDER BY d.d DESC "\
-                "LIMIT 1"\
-            ")"
-        ), (user_id,)
-    )
+    set_statement_timeout(cursor, timeout_ms)
+    cursor.execute(STREAK_QUERY, (user_id,))
     results = cursor.fetchall()
     get_connection().commit()
     return results[0][0]
 
-def add_to_table(table, user_id, value, backdate=None):
-    cursor = get_connection().cursor()
+def insert_query(table, user_id, value, backdate=None):
     if backdate:
-        cursor.execute(sql.SQL("INSERT INTO {} (id, value, created_at) VALUES (%s, %s, %s)").format(sql.Identifier(table)), (user_id, value, backdate))
-    else:
-        cursor.execute(sql.SQL("INSERT INTO {} (id, value) VALUES (%s, %s)").format(sql.Identifier(table)), (user_id, value))
+        return sql.SQL("INSERT INTO {} (id, value, created_at) VALUES (%s, %s, %s)").format(sql.Identifier(table)), (user_id, value, backdate)
+    return sql.SQL("INSERT INTO {} (id, value) VALUES (%s, %s)").format(sql.Identifier(table)), (user_id, value)
+
+def add_to_table(table, user_id, value, backdate=None, timeout_ms=None):
+    cursor = get_connection().cursor()
+    set_statement_timeout(cursor, timeout_ms)
+    cursor.execute(*insert_query(table, user_id, value, backdate))
     get_connection().commit()
     cursor.close()
 
+# Write-ahead spool: entries we couldn't get into the database are appended (and fsync'd) to a local file,
+# one JSON object per line, and replayed in order once the database is healthy again.
+SPOOL_LOCK = threading.Lock()
+
+def fsync_directory(path):
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+def read_spool(offset=0):
+    # The entries from offset bytes into the spool onwards, and the offset the spool ends at
+    if not os.path.exists(SPOOL_PATH):
+        return [], offset
+    with open(SPOOL_PATH, 'rb') as spool:
+        spool.seek(offset)
+        data = spool.read()
+    entries = []
+    for line in data.decode('utf-8', errors='replace').splitlines():
+        if not line.strip():
+            continue
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            # A torn write from a crash mid-append, the user was never told it was saved
+            print("Skipping unreadable spool line: {!r}".format(line))
+    return entries, offset + len(data)
+
+def append_to_spool(entry):
+    with SPOOL_LOCK:
+        created = not os.path.exists(SPOOL_PATH)
+        with open(SPOOL_PATH, 'a+b') as spool:
+            line = json.dumps(entry) + "\n"
+            # Don't let this entry run on from the end of a line torn by a crash
+            if spool.tell() > 0:
+                spool.seek(-1, os.SEEK_END)
+                if spool.read(1) != b"\n":
+                    line = "\n" + line
+            spool.write(line.encode('utf-8'))
+            spool.flush()
+            os.fsync(spool.fileno())
+        if created:
+            fsync_directory(SPOOL_PATH)
+
+def rewrite_spool(entries):
+    # Atomically replace the spool with the entries that are still pending
+    if not entries:
+        if os.path.exists(SPOOL_PATH):
+            os.remove(SPOOL_PATH)
+            fsync_directory(SPOOL_PATH)
+        return
+    temporary_path = SPOOL_PATH + ".tmp"
+    with open(temporary_path, 'w', encoding='utf-8') as spool:
+        for entry in entries:
+            spool.write(json.dumps(entry) + "\n")
+        spool.flush()
+        os.fsync(spool.fileno())
+    os.replace(temporary_path, SPOOL_PATH)
+    fsync_directory(SPOOL_PATH)
+
+def has_spooled_writes():
+    return os.path.exists(SPOOL_PATH)
+
+def apply_spooled_write(entry):
+    # The idempotency key is recorded in the same transaction as the row,
+    # so a replay interrupted before the spool is rewritten never inserts twice
+    user = entry["user"]
+    use_tenant(entry.get("tenant", DEFAULT_TENANT))
+    conn = get_connection()
+    cursor = conn.cursor()
+    set_statement_timeout(cursor, DB_WRITE_TIMEOUT_MS)
+    cursor.execute("INSERT INTO users(id, first_name, last_name, username) VALUES (%s, %s, %s, %s) ON CONFLICT (id) DO NOTHING",
+                   (user["id"], user["first_name"], user["last_name"], user["username"]))
+    cursor.execute("INSERT INTO spoolapplied (key) VALUES (%s) ON CONFLICT (key) DO NOTHING", (entry["key"],))
+    if cursor.rowcount == 1:
+        cursor.execute(sql.SQL("INSERT INTO {} (id, value, created_at) VALUES (%s, %s, %s)").format(sql.Identifier(entry["table"])),
+                       (user["id"], entry["value"], entry["created_at"]))
+    conn.commit()
+    cursor.close()
+
+def replay_spool(bot, job):
+    # Only the snapshot is taken under the lock, so new entries can still be spooled while a slow database is
+    # replayed into. The job queue runs one job at a time, so this is the only thing that ever rewrites the spool.
+    with SPOOL_LOCK:
+        if not has_spooled_writes():
+            return
+        entries, offset = read_spool()
+    replayed = 0
+    try:
+        for entry in entries:
+            try:
+                apply_spooled_write(entry)
+            except DB_UNAVAILABLE_ERRORS:
+                raise
+            except psycopg2.Error as e:
+                # Retrying won't help an entry the database rejects, don't let it block the rest
+                rollback_connection()
+                print("Dropping spooled write {}: {}".format(entry["key"], e))
+            replayed += 1
+    except DB_UNAVAILABLE_ERRORS as e:
+        rollback_connection()
+        print("Database still unavailable, {} spooled writes pending: {}".format(len(entries) - replayed, e))
+    with SPOOL_LOCK:
+        # Whatever was appended during the replay goes after what's still pending. A spool with nothing
+        # readable left in it is removed, so new writes go to the database again.
+        appended, _ = read_spool(offset)
+        rewrite_spool(entries[replayed:] + appended)
+
+    for tenant in {entry.get("tenant", DEFAULT_TENANT) for entry in entries[:replayed]}:
+        use_tenant(tenant)
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM spoolapplied WHERE created_at < now() - interval '7 days'")
+        conn.commit()
+        cursor.close()
+
+def save_entry(table, user, value, backdate=None, try_database=True):
+    # Goes straight to the database when it's healthy. When it's down, slow, or older writes are
+    # still waiting to be replayed (so they stay in order), the entry is spooled to disk instead.
+    # Returns whether the entry made it into the database.
+    if try_database and not has_spooled_writes():
+        try:
+            add_to_table(table, user.id, value, backdate, timeout_ms=DB_WRITE_TIMEOUT_MS)
+            return True
+        except DB_UNAVAILABLE_ERRORS as e:
+            rollback_connection()
+            print("Spooling write to {}: {}".format(table, e))
+
+    append_to_spool(make_spool_entry(table, user, value, backdate))
+    return False
+
+def make_spool_entry(table, user, value, backdate=None):
+    created_at = backdate or datetime.datetime.now()
+    return {
+        "key": uuid.uuid4().hex,
+        "tenant": get_tenant(),
+        "table": table,
+        "user": {
+            "id": user.id,
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+            "username": user.username,
+        },
+        "value": value,
+        "created_at": created_at.isoformat(),
+    }
+
 def add_meditation_reminder(user_id, value, midnight):
     cursor = get_connection().cursor()
     cursor.execute("INSERT INTO meditationreminders (id, value, midnight) VALUES (%s, %s, %s)", (user_id, value, midnight))
     get_connection().commit()
     cursor.close()
 
-def get_values(table, start_date=None, end_date=None, user_id=None, value=None):
-    cursor = get_connection().cursor()
+# Limits a query to the users seen in a group chat
+CHAT_MEMBERS_FILTER = "(%s is NULL OR id IN (SELECT user_id FROM chat_members WHERE chat_id = %s)) "
+
+def values_query(table, start_date=None, end_date=None, user_id=None, value=None, chat_id=None):
     query = sql.SQL("SELECT * FROM {} WHERE "\
                     "(%s is NULL OR id = %s) "\
+                    "AND " + CHAT_MEMBERS_FILTER +\
                     "AND (%s is NULL OR created_at > %s) "\
                     "AND (%s is NULL OR created_at < %s) "\
                     "AND (%s is NULL OR value = %s);").format(sql.Identifier(table))
-    cursor.execute(query, (user_id, user_id, start_date, start_date, end_date, end_date, value, value))
+    return query, (user_id, user_id, chat_id, chat_id, start_date, start_date, end_date, end_date, value, value)
+
+def get_values(table, start_date=None, end_date=None, user_id=None, value=None, chat_id=None, timeout_ms=None):
+    cursor = get_connection().cursor()
+    set_statement_timeout(cursor, timeout_ms)
+    cursor.execute(*values_query(table, start_date, end_date, user_id, value, chat_id))
     results = cursor.fetchall()
     get_connection().commit()
     return results
 
+# How a day's worth of entries collapses into one value in the daily series
+DAILY_AGGREGATES = {
+    "meditation": "SUM",
+    "sleep": "SUM",
+    "fasting": "SUM",
+    "happiness": "AVG",
+    "anxiety": "AVG",
+}
+
+def daily_series_query(tables, start_date=None, end_date=None, user_id=None, chat_id=None):
+    # One round-trip for every table: each table is aggregated per day and the results are UNION ALL'd together
+    selects = []
+    params = []
+    for table in tables:
+        selects.append(sql.SQL("SELECT {} AS metric, created_at::date AS day, {}(value)::float AS value FROM {} WHERE "\
+                               "(%s is NULL OR id = %s) "\
+                               "AND " + CHAT_MEMBERS_FILTER +\
+                               "AND (%s is NULL OR created_at > %s) "\
+                               "AND (%s is NULL OR created_at < %s) "\
+                               "GROUP BY 2").format(sql.Literal(table), sql.SQL(DAILY_AGGREGATES[table]), sql.Identifier(table)))
+        params.extend([user_id, user_id, chat_id, chat_id, start_date, start_date, end_date, end_date])
+    return sql.SQL(" UNION ALL ").join(selects), params
+
+def series_from_rows(tables, rows):
+    series = {table: {} for table in tables}
+    for metric, day, value in rows:
+        series[metric][day] = value
+    return series
+
+def get_daily_series(tables, start_date=None, end_date=None, user_id=None, chat_id=None):
+    cursor = get_connection().cursor()
+    cursor.execute(*daily_series_query(tables, start_date, end_date, user_id, chat_id))
+    results = cursor.fetchall()
+    get_connection().commit()
+    cursor.close()
+    return series_from_rows(tables, results)
+
 def delete_message(bot, chat_id, message_id):
     try:
         bot.deleteMessage(chat_id=chat_id, message_id=message_id)
     except BadRequest:
         pass
 
+# What a command costs from the user's and the chat's token buckets
+COST_CHEAP = 1
+COST_MODERATE = 3
+COST_EXPENSIVE = 10
+
+ADMISSION_LOCK = threading.Lock()
+USER_BUCKETS = {}
+CHAT_BUCKETS = {}
+IN_FLIGHT = set()
+THROTTLE_NOTICES = {}
+EXPENSIVE_EXECUTOR = ThreadPoolExecutor(max_workers=EXPENSIVE_WORKERS)
+
+def refill_bucket(buckets, key, capacity, refill, now):
+    tokens, last_refill = buckets.get(key, (capacity, now))
+    return min(capacity, tokens + (now - last_refill) * refill)
+
+def take_tokens(user_key, chat_key, cost, now):
+    # Both buckets have to be able to pay, otherwise neither is charged
+    user_tokens = refill_bucket(USER_BUCKETS, user_key, ADMISSION_USER_CAPACITY, ADMISSION_USER_REFILL, now)
+    chat_tokens = refill_bucket(CHAT_BUCKETS, chat_key, ADMISSION_CHAT_CAPACITY, ADMISSION_CHAT_REFILL, now)
+    allowed = user_tokens >= cost and chat_tokens >= cost
+    if allowed:
+        user_tokens -= cost
+        chat_tokens -= cost
+    USER_BUCKETS[user_key] = (user_tokens, now)
+    CHAT_BUCKETS[chat_key] = (chat_tokens, now)
+    return allowed
+
+def get_request_key(message, shared):
+    owner = message.chat.id if shared else (message.chat.id, message.from_user.id)
+    # A private chat has the same id with every tenant's bot
+    if message.document:
+        # An uploaded file has no text, sending the same file again is the same import
+        return (get_tenant(), owner, message.document.file_id)
+    if not message.text:
+        return None
+    # "/TOP@zenafbot  5" and "/top 5" are the same request
+    parts = message.text.lower().split()
+    parts[0] = parts[0].split("@")[0]
+    return (get_tenant(), owner, " ".join(parts))
+
+def admitted(handler, cost, shared=False):
+    # shared=True means the reply is the same for everyone in the chat (eg. /top),
+    # so identical requests from different members are coalesced too
+    def admission_handler(bot, update):
+        message = update.message
+        # Every tenant's bot has its own budgets, a private chat has the same id with all of them
+        user_key = (get_tenant(), message.from_user.id)
+        chat_key = (get_tenant(), message.chat.id)
+        now = time.monotonic()
+        request_key = get_request_key(message, shared) if cost >= COST_EXPENSIVE else None
+
+        with ADMISSION_LOCK:
+            if request_key in IN_FLIGHT:
+                coalesced = True
+                allowed = False
+            else:
+                coalesced = False
+                allowed = take_tokens(user_key, chat_key, cost, now)
+            if allowed and request_key:
+                IN_FLIGHT.add(request_key)
+            notify = not allowed and not coalesced and now - THROTTLE_NOTICES.get(user_key, -ADMISSION_NOTICE_INTERVAL) >= ADMISSION_NOTICE_INTERVAL
+            if notify:
+                THROTTLE_NOTICES[user_key] = now
+
+        if coalesced:
+            # The identical request already in flight will answer this one as well
+            delete_message(bot, message.chat.id, message.message_id)
+            return
+        if not allowed:
+            if notify:
+                send_throttle_notice(bot, message)
+            return
+
+        try:
+            if request_key and not ASYNC_MODE:
+                # The dispatcher runs handlers one at a time, so an expensive one has to move off its thread
+                # for an identical request to ever arrive while it's still in flight
+                result = EXPENSIVE_EXECUTOR.submit(run_in_tenant, get_tenant(), handler, bot, update)
+                result.add_done_callback(report_future_error)
+            else:
+                result = handler(bot, update)
+        except BaseException:
+            release_request(request_key)
+            raise
+        if isinstance(result, Future):
+            # Handlers running on a worker thread or the asyncio loop stay in flight until they're done
+            result.add_done_callback(lambda _: release_request(request_key))
+        else:
+            release_request(request_key)
+
+    return admission_handler
+
+def send_throttle_notice(bot, message):
+    text = "🐢 Easy there! You're sending me commands faster than I can keep up with. Please give it a minute and try again. 🙏"
+    try:
+        bot.send_message(chat_id=message.from_user.id, text=text)
+    except Unauthorized:
+        # They've never PMed us, so answer the throttled command in the group instead
+        if message.chat.id != message.from_user.id:
+            bot.send_message(chat_id=message.chat.id, text=text, reply_to_message_id=message.message_id)
+
+def run_in_tenant(tenant, function, *args):
+    # Worker threads don't see the tenant the dispatcher thread selected for the update
+    use_tenant(tenant)
+    return function(*args)
+
+def release_request(request_key):
+    if request_key:
+        with ADMISSION_LOCK:
+            IN_FLIGHT.discard(request_key)
+
+# Bulk history import, for the /import command and `python bot.py import`. Rows of (metric, value, timestamp)
+# from a CSV or JSON Lines file are checked against the same rules as the logging commands and loaded with
+# COPY FROM STDIN, one transaction per batch.
+
+# How many invalid rows are listed back to the user
+IMPORT_MAX_ERRORS = 10
+
+# table -> (type, minimum, maximum), text values are bounded by their length
+METRIC_RULES = {
+    "meditation": (int, 5, 1440),
+    "anxiety": (int, 0, 10),
+    "happiness": (int, 0, 10),
+    "sleep": (float, 0, 24),
+    "fasting": (float, 0, None),
+    "exercise": (str, 1, 4000),
+    "done": (str, 1, 4000),
+    "journal": (str, 1, 4000),
+}
+METRIC_ALIASES = {"meditate": "meditation", "fast": "fasting"}
+
+IMPORT_TIMESTAMP_FORMATS = [
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M",
+]
+IMPORT_DATE_FORMAT = "%Y-%m-%d"
+
+def parse_metric_value(table, text):
+    # Raises ValueError when the value isn't the right kind of number, returns None when it's out of range
+    kind, minimum, maximum = METRIC_RULES[table]
+    value = kind(text)
+    if kind is float and not math.isfinite(value):
+        raise ValueError(text)
+    size = len(value) if kind is str else value
+    if size < minimum or (maximum is not None and size > maximum):
+        return None
+    return value
+
+def parse_timestamp(text):
+    text = text.strip().replace("T", " ").rstrip("Z")
+    try:
+        return datetime.datetime.strptime(text, IMPORT_DATE_FORMAT).replace(hour=12)
+    except ValueError:
+        pass
+    for timestamp_format in IMPORT_TIMESTAMP_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, timestamp_format)
+        except ValueError:
+            pass
+    return None
+
+def read_rows(text):
+    # Yields (line number, metric, value, timestamp) as found in the file, or (line number, error) for unreadable rows
+    text = text.lstrip("\ufeff")
+    if text.lstrip().startswith("{"):
+        for number, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                yield number, record["metric"], record["value"], record["timestamp"]
+            except (ValueError, TypeError, KeyError):
+                yield number, "expected a JSON object with metric, value and timestamp"
+    else:
+        # csv tracks the line number itself, quoted journal entries can span several lines
+        reader = csv.reader(io.StringIO(text, newline=""))
+        for record in reader:
+            if not record or (reader.line_num == 1 and record[0].strip().lower() == "metric"):
+                continue
+            if len(record) != 3:
+                yield reader.line_num, "expected 3 columns (metric, value, timestamp)"
+                continue
+            yield (reader.line_num,) + tuple(record)
+
+def read_history(text, now=None):
+    # Returns the (table, value, created_at) rows to import and a list of problems with line numbers
+    now = now or datetime.datetime.now()
+    rows = []
+    errors = []
+    for row in read_rows(text):
+        if len(row) == 2:
+            errors.append("line {}: {}".format(*row))
+            continue
+        number, metric, value, timestamp = row
+        table = str(metric).strip().lower()
+        table = METRIC_ALIASES.get(table, table)
+        if table not in METRIC_RULES:
+            errors.append("line {}: unknown metric `{}`".format(number, metric))
+            continue
+        # JSON numbers go through their text form so 7.5 is still rejected as a whole number
+        raw_value = value if isinstance(value, str) else json.dumps(value)
+        try:
+            parsed = parse_metric_value(table, raw_value)
+        except ValueError:
+            errors.append("line {}: `{}` isn't a valid {} value".format(number, value, table))
+            continue
+        if parsed is None:
+            errors.append("line {}: {} value `{}` is out of range".format(number, table, value))
+            continue
+        created_at = parse_timestamp(str(timestamp))
+        if created_at is None:
+            errors.append("line {}: couldn't read the timestamp `{}`".format(number, timestamp))
+            continue
+        if created_at > now:
+            errors.append("line {}: {} is in the future".format(number, created_at.isoformat(" ")))
+            continue
+        rows.append((table, parsed, created_at))
+    return rows, errors
+
+def copy_batches(conn, user_id, rows, batch_size=IMPORT_BATCH_SIZE):
+    # COPYs the rows in, one transaction per batch, yielding how many rows each committed batch held
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        tables = defaultdict(io.StringIO)
+        for table, value, created_at in batch:
+            csv.writer(tables[table]).writerow([user_id, value, created_at.isoformat(" ")])
+
+        cursor = conn.cursor()
+        try:
+            for table, buffer in sorted(tables.items()):
+                buffer.seek(0)
+                query = sql.SQL("COPY {} (id, value, created_at) FROM STDIN WITH (FORMAT csv)").format(sql.Identifier(table))
+                cursor.copy_expert(query, buffer)
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        yield len(batch)
+
+def count_by_table(rows):
+    counts = Counter(table for table, _, _ in rows)
+    return ", ".join("{} {}".format(count, table) for table, count in sorted(counts.items()))
+
+def importhistory(bot, update):
+    message = update.message
+    user_id = message.from_user.id
+    document = message.document
+    if document is None or not (message.caption or "").startswith("/import"):
+        delete_message(bot, message.chat.id, message.message_id)
+        bot.send_message(chat_id=user_id, parse_mode="Markdown", text="📥 Send me a CSV or JSON Lines file in this chat with `/import` as its caption. "\
+                        "Each row needs a metric (eg. `meditation`, `sleep`, `happiness`), a value and a date like `2017-12-24` or `2017-12-24 07:30`, "\
+                        "eg. `meditation,20,2017-12-24`. Importing the same file twice logs everything twice!")
+        return
+
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        bot.send_message(chat_id=user_id, text="📥 That file is too big, please split it into files under {}MB.".format(IMPORT_MAX_BYTES // (1024 * 1024)))
+        return
+
+    get_or_create_user(bot, update)
+    data = bot.get_file(document.file_id).download_as_bytearray()
+    try:
+        text = bytes(data).decode("utf-8-sig")
+    except UnicodeDecodeError:
+        bot.send_message(chat_id=user_id, text="📥 I couldn't read that file, please save it as UTF-8 text.")
+        return
+
+    rows, errors = read_history(text)
+    if errors:
+        shown = "\n".join(errors[:IMPORT_MAX_ERRORS])
+        more = "\n...and {} more".format(len(errors) - IMPORT_MAX_ERRORS) if len(errors) > IMPORT_MAX_ERRORS else ""
+        bot.send_message(chat_id=user_id, text="📥 Nothing was imported, {} rows have problems:\n{}{}".format(len(errors), shown, more))
+        return
+    if not rows:
+        bot.send_message(chat_id=user_id, text="📥 That file doesn't have anything to import.")
+        return
+
+    imported = 0
+    try:
+        for count in copy_batches(get_connection(), user_id, rows):
+            imported += count
+    except DB_UNAVAILABLE_ERRORS:
+        rollback_connection()
+        bot.send_message(chat_id=user_id, text="📥 I lost the database after importing {} of {} rows, please send the remaining rows again later.".format(imported, len(rows)))
+        return
+    bot.send_message(chat_id=user_id, text="✅ Imported {} entries ({})! 📥".format(imported, count_by_table(rows)))
+
+def import_history_cli(argv):
+    parser = argparse.ArgumentParser(prog='bot.py import', description="Import a CSV or JSON Lines file of (metric, value, timestamp) rows, "\
+                                     "eg. `meditation,20,2017-12-24 07:30`, for a user who has already talked to the bot.")
+    parser.add_argument('path', help='CSV or JSON Lines file to import')
+    parser.add_argument('--user', type=int, required=True, help='Telegram user id to import the history for')
+    parser.add_argument('--tenant', default=next(iter(TENANTS)), choices=list(TENANTS), help='which bot the user belongs to, from BOT_TOKENS')
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help='rows per COPY transaction')
+    parser.add_argument('--dry-run', action='store_true', help='only validate the file')
+    args = parser.parse_args(argv)
+
+    with open(args.path, encoding='utf-8-sig', newline='') as history:
+        rows, errors = read_history(history.read())
+    if errors:
+        print("Nothing was imported, {} rows have problems:".format(len(errors)))
+        for error in errors:
+            print("  " + error)
+        sys.exit(1)
+    print("{} valid rows ({})".format(len(rows), count_by_table(rows) or "nothing to import"))
+    if args.dry_run or not rows:
+        return
+
+    use_tenant(args.tenant)
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT 1 FROM users WHERE id = %s', (args.user,))
+    exists = cursor.fetchone() is not None
+    cursor.close()
+    if not exists:
+        print("User {} has never talked to the bot, they need to send it a message first".format(args.user))
+        sys.exit(1)
+
+    started = datetime.datetime.now()
+    imported = 0
+    for count in copy_batches(conn, args.user, rows, args.batch_size):
+        imported += count
+        print("{}/{} rows imported".format(imported, len(rows)))
+    print("Done in {:.1f}s".format((datetime.datetime.now() - started).total_seconds()))
+
 def help_message(bot, update):
     message = \
         "/top = Shows top 5 people with the highest meditation streak\n"\
@@ -119,12 +819,15 @@ def help_message(bot, update):
         "/journal \[entry] \[backdate?] = Log a journal entry (Either publicly or in private to @zenafbot)\n"\
         "/meditate \[minutes] \[backdate?] = Record your meditation\n"\
         "/sleep \[0-24] \[backdate?] = Record your sleep (hours)\n"\
+        "/import = Send me a CSV or JSON Lines file with `/import` as its caption to load your history from another tracker\n"\
         "\n"\
-        "`[period]` = either `weekly`, `biweekly`, `monthly` or `all`\n"\
+        "`[period]` = either `weekly`, `biweekly`, `monthly` or `all`. Add `text` to any stats command for a quick text summary instead of a chart\n"\
         "/anxietystats \[period] = Graph of your anxiety levels\n"\
+        "/dashboard \[period] = All of your stats in one picture\n"\
         "/fastingstats \[period] = Graph of your fasts\n"\
         "/groupstats \[period] = Total meditation time by the group\n"\
         "/happystats \[period] = Graph of your happiness levels\n"\
+        "/insights \[period] = Trends and correlations between your meditation, sleep, fasting and mood\n"\
         "/journalentries \[dd-mm-yyyy] = Retrieve journal entries from date\n"\
         "/meditatestats \[period] = Graph of your meditation history\n"\
         "/sleepstats \[period] = Graph of your sleep history"
@@ -159,14 +862,23 @@ def pm(bot, update):
 
 def meditate(bot, update):
     def validation_callback(parts):
-        value = int(parts[0])
-        if value < 5 or value > 1440:
+        value = parse_metric_value("meditation", parts[0])
+        if value is None:
             bot.send_message(chat_id=update.message.from_user.id, text="🙏 Meditation time must be between 5 and 1440 minutes. 🙏")
             return False
         return value
 
-    def success_callback(name_to_show, value, update, historic_date):
-        streak = get_streak_of(update.message.from_user.id)
+    def success_callback(name_to_show, value, update, historic_date, saved):
+        streak = None
+        # A spooled meditation isn't counted yet, so skip the streak rather than show the wrong one
+        if saved:
+            try:
+                streak = get_streak_of(update.message.from_user.id, timeout_ms=DB_WRITE_TIMEOUT_MS)
+            except DB_UNAVAILABLE_ERRORS:
+                rollback_connection()
+        if streak is None:
+            bot.send_message(chat_id=update.message.chat.id, text="✅ {} meditated for {} minutes{} 🙏".format(name_to_show, value, historic_date))
+            return
         emoji = get_streak_emoji(streak)
         bot.send_message(chat_id=update.message.chat.id, text="✅ {} meditated for {} minutes{} ({}{}) 🙏".format(name_to_show, value, historic_date, streak, emoji))
 
@@ -225,7 +937,8 @@ def schedulereminders(bot, update):
         bot.send_message(chat_id=update.message.from_user.id, text="Okay {}, I've scheduled those reminders for you! 🕑 "\
                         "If you haven't already, please send me a PM at @zenafbot so that I can PM your reminders to you!".format(username))
 
-def executereminders(bot, _):
+def executereminders(bot, job):
+    use_tenant(job.context)
     now = datetime.datetime.now()
     users_to_notify = get_values("meditationreminders", value=now.hour)
     for user in users_to_notify:
@@ -244,11 +957,18 @@ def executereminders(bot, _):
             bot.send_message(chat_id=user_id, text="Hey! You asked me to send you a private message to remind you to meditate! 🙏 "\
                                                    "You can turn off these notifications with `/reminders off`. 🕑")
 
-def find_rating_change(table, user_id, new_value):
+def find_rating_change(table, user_id, new_value, saved=True):
+    # A spooled rating isn't in the database yet to compare against
+    if not saved:
+        return ""
     now = datetime.datetime.now()
     yesterday = get_x_days_before(now, 1)
     # We want to find change in rating between current value and most recent value in 24 last hours
-    ratings_last_day = get_values(table, start_date=yesterday, end_date=now, user_id=user_id)
+    try:
+        ratings_last_day = get_values(table, start_date=yesterday, end_date=now, user_id=user_id, timeout_ms=DB_WRITE_TIMEOUT_MS)
+    except DB_UNAVAILABLE_ERRORS:
+        rollback_connection()
+        return ""
     difference_str = ""
     if len(ratings_last_day) > 1:
         ratings_last_day.sort(key=lambda r: r[2], reverse=True)
@@ -258,13 +978,13 @@ def find_rating_change(table, user_id, new_value):
 
 def anxiety(bot, update):
     def validation_callback(parts):
-        value = int(parts[0])
-        if value < 0 or value > 10:
+        value = parse_metric_value("anxiety", parts[0])
+        if value is None:
             bot.send_message(chat_id=update.message.from_user.id, text="Please rate your anxiety between 0 (low) and 10 (high).")
             return False
         return value
 
-    def success_callback(name_to_show, value, update, historic_date):
+    def success_callback(name_to_show, value, update, historic_date, saved):
         if value >= 9:
             emoji = "😭"
         elif value >= 7:
@@ -276,7 +996,7 @@ def anxiety(bot, update):
         else:
             emoji = "😎"
 
-        difference = find_rating_change("anxiety", update.message.from_user.id, value)
+        difference = find_rating_change("anxiety", update.message.from_user.id, value, saved)
         bot.send_message(chat_id=update.message.chat.id,
                          text="{} {} rated their anxiety at {}{}{} {}".format(emoji, name_to_show, value, difference, historic_date, emoji))
 
@@ -288,13 +1008,13 @@ def anxiety(bot, update):
 
 def happiness(bot, update):
     def validation_callback(parts):
-        value = int(parts[0])
-        if value < 0 or value > 10:
+        value = parse_metric_value("happiness", parts[0])
+        if value is None:
             bot.send_message(chat_id=update.message.from_user.id, text="Please rate your happiness level 0-10")
             return False
         return value
 
-    def success_callback(name_to_show, value, update, historic_date):
+    def success_callback(name_to_show, value, update, historic_date, saved):
         if value >= 9:
             emoji = "😎"
         elif value >= 7:
@@ -310,7 +1030,7 @@ def happiness(bot, update):
         else:
             emoji = "😭"
 
-        difference = find_rating_change("happiness", update.message.from_user.id, value)
+        difference = find_rating_change("happiness", update.message.from_user.id, value, saved)
         bot.send_message(chat_id=update.message.chat.id,
                          text="{} {} rated their happiness at {}{}{} {}".format(emoji, name_to_show, value, difference, historic_date, emoji))
 
@@ -322,13 +1042,13 @@ def happiness(bot, update):
 
 def sleep(bot, update):
     def validation_callback(parts):
-        value = float(parts[0])
-        if value < 0 or value > 24:
+        value = parse_metric_value("sleep", parts[0])
+        if value is None:
             bot.send_message(chat_id=update.message.from_user.id, text="💤 Please give how many hours you slept. 💤")
             return False
         return value
 
-    def success_callback(name_to_show, value, update, historic_date):
+    def success_callback(name_to_show, value, update, historic_date, _):
         bot.send_message(chat_id=update.message.chat.id, text="✅ {} slept for {} hours{} 💤".format(name_to_show, value, historic_date))
 
     delete_and_send(bot, update, validation_callback, success_callback, {
@@ -339,13 +1059,13 @@ def sleep(bot, update):
 
 def fasting(bot, update):
     def validation_callback(parts):
-        value = float(parts[0])
-        if value < 0:
+        value = parse_metric_value("fasting", parts[0])
+        if value is None:
             bot.send_message(chat_id=update.message.from_user.id, text="🍽 Please give how many hours you fasted for. 🍽")
             return False
         return value
 
-    def success_callback(name_to_show, value, update, historic_date):
+    def success_callback(name_to_show, value, update, historic_date, _):
         bot.send_message(chat_id=update.message.chat.id, text="✅ {} fasted for {} hours{} 🍽".format(name_to_show, value, historic_date))
 
     delete_and_send(bot, update, validation_callback, success_callback, {
@@ -356,14 +1076,13 @@ def fasting(bot, update):
 
 def done(bot, update):
     def validation_callback(parts):
-        activity = " ".join(parts)
-        activity_len = len(activity)
-        if activity_len == 0 or activity_len > 4000:
-            bot.send.message(chat_id=update.message.from_user.id, text="Please list your activity between 0 and 4000 characters!")
+        activity = parse_metric_value("done", " ".join(parts))
+        if activity is None:
+            bot.send_message(chat_id=update.message.from_user.id, text="Please list your activity between 0 and 4000 characters!")
             return False
         return activity
 
-    def success_callback(name_to_show, value, update, historic_date):
+    def success_callback(name_to_show, value, update, historic_date, _):
         bot.send_message(chat_id=update.message.chat.id, text="✅ {} completed{}: {}".format(name_to_show, historic_date, value))
 
     delete_and_send(bot, update, validation_callback, success_callback, {
@@ -374,14 +1093,13 @@ def done(bot, update):
 
 def exercise(bot, update):
     def validation_callback(parts):
-        activity = " ".join(parts)
-        activity_len = len(activity)
-        if activity_len == 0 or activity_len > 4000:
+        activity = parse_metric_value("exercise", " ".join(parts))
+        if activity is None:
             bot.send_message(chat_id=update.message.from_user.id, text="💪 Please list your activity between 0 and 4000 characters! 💪")
             return False
         return activity
 
-    def success_callback(name_to_show, value, update, historic_date):
+    def success_callback(name_to_show, value, update, historic_date, _):
         bot.send_message(chat_id=update.message.chat.id, text="✅ {} exercised{}: {}".format(name_to_show, historic_date, value))
 
     delete_and_send(bot, update, validation_callback, success_callback, {
@@ -391,8 +1109,13 @@ def exercise(bot, update):
     })
 
 def rest(bot, update):
-    get_or_create_user(bot, update)
-    add_to_table("exercise", update.message.from_user.id, "rest")
+    try:
+        get_or_create_user(bot, update, timeout_ms=DB_WRITE_TIMEOUT_MS)
+        database_ok = True
+    except DB_UNAVAILABLE_ERRORS:
+        rollback_connection()
+        database_ok = False
+    save_entry("exercise", update.message.from_user, "rest", try_database=database_ok)
     delete_message(bot, update.message.chat.id, update.message.message_id)
     name_to_show = get_name(update.message.from_user)
     bot.send_message(chat_id=update.message.chat.id, text="✅ {} is resting today!".format(name_to_show,))
@@ -433,14 +1156,13 @@ def summary(bot, update):
 def journaladd(bot, update):
     def validation_callback(parts):
         # String will always fit in db as db stores as much as max length for telegram message
-        journalentry = " ".join(parts)
-        journalentry_len = len(journalentry)
-        if journalentry_len == 0 or journalentry_len > 4000:
+        journalentry = parse_metric_value("journal", " ".join(parts))
+        if journalentry is None:
             bot.send_message(chat_id=update.message.from_user.id, text="✏️  Please give a journal entry between 0 and 4000 characters! ✏️")
             return False
         return journalentry
 
-    def success_callback(name_to_show, _, update, historic_date):
+    def success_callback(name_to_show, _, update, historic_date, __):
         bot.send_message(chat_id=update.message.chat.id, text="✅ {} logged a journal entry{}! ✏️".format(name_to_show, historic_date))
 
     delete_and_send(bot, update, validation_callback, success_callback, {
@@ -479,6 +1201,27 @@ def top(bot, update):
     get_or_create_user(bot, update)
     parts = update.message.text.split(" ")
 
+    count = get_top_count(parts)
+
+    results = []
+    cursor = get_connection().cursor()
+    cursor.execute(*chat_users_query(get_group_chat_id(update.message)))
+    users = cursor.fetchall()
+    get_connection().commit()
+    for user in users:
+        results.append((user[1], user[2], user[3], get_streak_of(user[0])))
+
+    message = format_leaderboard(results, count)
+    delete_message(bot, update.message.chat.id, update.message.message_id)
+    bot.send_message(chat_id=update.message.chat_id, text=message)
+
+def chat_users_query(chat_id):
+    # Everyone for a private chat, only the members seen in the chat for a group
+    if chat_id is None:
+        return "SELECT * FROM users;", None
+    return "SELECT users.* FROM chat_members JOIN users ON users.id = chat_members.user_id WHERE chat_members.chat_id = %s;", (chat_id,)
+
+def get_top_count(parts):
     count = 5
 
     if len(parts) > 1:
@@ -487,15 +1230,9 @@ def top(bot, update):
         except ValueError:
             pass
 
-    count = min(count, 20)
+    return min(count, 20)
 
-    results = []
-    cursor = get_connection().cursor()
-    cursor.execute("SELECT * FROM users;")
-    users = cursor.fetchall()
-    get_connection().commit()
-    for user in users:
-        results.append((user[1], user[2], user[3], get_streak_of(user[0])))
+def format_leaderboard(results, count):
     results.sort(key=lambda x: x[3], reverse=True)
     top_users = results[:count]
 
@@ -513,9 +1250,7 @@ def top(bot, update):
 
         line.append(f'{i + 1}. {name_to_show}   ({streak}{emoji})')
 
-    message = '\n'.join(line)
-    delete_message(bot, update.message.chat.id, update.message.message_id)
-    bot.send_message(chat_id=update.message.chat_id, text=message)
+    return '\n'.join(line)
 
 def streak(bot, update):
     get_or_create_user(bot, update)
@@ -529,7 +1264,17 @@ def streak(bot, update):
     bot.send_message(chat_id=update.message.chat.id, text="{} has a meditation streak of {}! {}".format(name_to_show, streak, emoji))
 
 def delete_and_send(bot, update, validation_callback, success_callback, strings, backdate=None):
-    get_or_create_user(bot, update)
+    if ASYNC_MODE:
+        return run_coroutine(aio_delete_and_send(bot, update, validation_callback, success_callback, strings, backdate))
+
+    try:
+        get_or_create_user(bot, update, timeout_ms=DB_WRITE_TIMEOUT_MS)
+        database_ok = True
+    except DB_UNAVAILABLE_ERRORS:
+        # Still take the entry, the user is created when the spool is replayed. The database
+        # has already used up the budget, so don't make the user wait on it a second time.
+        rollback_connection()
+        database_ok = False
     parts = update.message.text.split(' ')
     #No command needs parts[0] as it's just the name of the command to be executed.
     parts = parts[1:]
@@ -537,6 +1282,27 @@ def delete_and_send(bot, update, validation_callback, success_callback, strings,
         bot.send_message(chat_id=update.message.from_user.id, text=strings["wrong_length"])
         return
 
+    parts, backdate, backdate_err = split_backdate(parts, backdate)
+    if backdate_err:
+        bot.send_message(chat_id=update.message.from_user.id, text=backdate_err)
+        return
+
+    try:
+        value = validation_callback(parts)
+        if value is False:
+            return
+    except ValueError:
+        bot.send_message(chat_id=update.message.from_user.id, text=strings["value_error"])
+        return
+
+    saved = save_entry(strings["table_name"], update.message.from_user, value, backdate, try_database=database_ok)
+    delete_message(bot, update.message.chat.id, update.message.message_id)
+
+    historic_date = "" if backdate is None else " on " + backdate.date().isoformat()
+    success_callback(get_name(update.message.from_user), value, update, historic_date, saved)
+
+def split_backdate(parts, backdate=None):
+    # Returns the parts without the backdate word, the backdate, and an error message if it was out of range
     #ALLOW A USER TO BACKDATE THEIR RECORD
     if len(parts) > 1:
         #Try to parse the last 'word' of the user input (eg 24-12-2017)
@@ -558,26 +1324,14 @@ def delete_and_send(bot, update, validation_callback, success_callback, strings,
         else:
             # Error, the backdate was parsed but was not in the appropriate date range
             backdate_err = "The backdated date {} (from `{}`) did not take place in the last month.".format(backdate.date().isoformat(), parts[-1])
-            bot.send_message(chat_id=update.message.from_user.id, text=backdate_err)
-            return
+            return parts, None, backdate_err
 
-    try:
-        value = validation_callback(parts)
-        if value is False:
-            return
-    except ValueError:
-        bot.send_message(chat_id=update.message.from_user.id, text=strings["value_error"])
-        return
-
-    add_to_table(strings["table_name"], update.message.from_user.id, value, backdate)
-    delete_message(bot, update.message.chat.id, update.message.message_id)
-
-    historic_date = "" if backdate is None else " on " + backdate.date().isoformat()
-    success_callback(get_name(update.message.from_user), value, update, historic_date)
+    return parts, backdate, None
 
-def get_or_create_user(bot, update):
+def get_or_create_user(bot, update, timeout_ms=None):
     user = update.message.from_user
     cursor = get_connection().cursor()
+    set_statement_timeout(cursor, timeout_ms)
 
     cursor.execute('SELECT * FROM users WHERE id = %s', (user.id,))
     result = cursor.fetchone()
@@ -588,22 +1342,41 @@ def get_or_create_user(bot, update):
             value = getattr(user, attribute, None)
             values.append(value)
 
+        has_pm = update.message.chat_id == update.message.from_user.id
+        values.append(has_pm)
+
+        # Another command from the same new user may be running on a worker thread, only one of them creates the row
+        cursor.execute("INSERT INTO users(id, first_name, last_name, username, haspm) VALUES (%s, %s, %s, %s, %s) ON CONFLICT (id) DO NOTHING", values)
+
         # If command was run in public, ask them to PM us!
-        if update.message.chat_id is not update.message.from_user.id:
+        if cursor.rowcount == 1 and not has_pm:
             bot.send_message(chat_id=update.message.chat_id, text="Hey {}! Please message me at @zenafbot so that I can PM you!".format(get_name(user)))
-            values.append(False)
-        else:
-            values.append(True)
-
-        cursor.execute("INSERT INTO users(id, first_name, last_name, username, haspm) VALUES (%s, %s, %s, %s, %s)", values)
 
         cursor.execute('SELECT * FROM users WHERE id = %s', (user.id,))
         result = cursor.fetchone()
 
+    member = get_chat_member(update.message)
+    if member and member not in SEEN_CHAT_MEMBERS:
+        cursor.execute(CHAT_MEMBER_INSERT, member[1:])
+
     get_connection().commit()
     cursor.close()
+    if member:
+        SEEN_CHAT_MEMBERS.add(member)
     return result
 
+# (tenant, chat, user) already in chat_members, so every command in a group doesn't repeat the insert
+SEEN_CHAT_MEMBERS = set()
+CHAT_MEMBER_INSERT = "INSERT INTO chat_members (chat_id, user_id) VALUES (%s, %s) ON CONFLICT DO NOTHING"
+
+def get_group_chat_id(message):
+    # A private chat has the user's id, it isn't a community so it keeps seeing everyone
+    return None if message.chat_id == message.from_user.id else message.chat_id
+
+def get_chat_member(message):
+    chat_id = get_group_chat_id(message)
+    return None if chat_id is None else (get_tenant(), chat_id, message.from_user.id)
+
 def get_name(user):
     if user.username:
         name_to_show = "@" + user.username
@@ -614,46 +1387,84 @@ def get_name(user):
 def get_x_days_before(start_date, days_before):
     return start_date - datetime.timedelta(days=days_before)
 
+PERIOD_DAYS = {
+    'weekly': 7,
+    'biweekly': 14,
+    'monthly': 31,
+    # Unbounded search for all dates
+    'all': None,
+}
+
+def get_period_start(period, now):
+    # Anything we don't recognise defaults to a week ago
+    days = PERIOD_DAYS.get(period, 7)
+    if days is None:
+        return None
+    return get_x_days_before(now, days)
+
+# command -> (table, keyword arguments for the report)
+STATS_REPORTS = {
+    "/meditatestats": ("meditation", {}),
+    "/anxietystats": ("anxiety", {}),
+    "/sleepstats": ("sleep", {"calc_average": True}),
+    "/groupstats": ("meditation", {"all_data": True}),
+    # synonyms as 'happinessstats' is weird AF
+    "/happinessstats": ("happiness", {}),
+    "/happystats": ("happiness", {}),
+    "/fastingstats": ("fasting", {}),
+}
+STATS_MODES = ["text", "chart"]
+# Periods of at most this many days are sent as text unless `chart` is asked for
+STATS_TEXT_DEFAULT_DAYS = int(os.environ.get('STATS_TEXT_DEFAULT_DAYS', 0))
+
+def parse_stats_request(text, now):
+    # Returns the table, report options, start date and output mode asked for
+    parts = text.split(' ')
+    command = parts[0].split("@")[0]
+
+    # Period and output mode can come in either order, eg. `/meditatestats weekly text`
+    period = None
+    mode = None
+    for part in parts[1:]:
+        if part in STATS_MODES:
+            mode = part
+        elif part:
+            period = part
+
+    start_date = get_period_start(period, now)
+    if mode is None:
+        is_short_period = start_date is not None and (now - start_date).days <= STATS_TEXT_DEFAULT_DAYS
+        mode = "text" if is_short_period else "chart"
+
+    table, options = STATS_REPORTS[command]
+    return table, options, start_date, mode
+
 def stats(bot, update):
     get_or_create_user(bot, update)
-    parts = update.message.text.split(' ')
-    command = parts[0].split("@")[0]
     user = update.message.from_user
-
     now = datetime.datetime.now()
-    if len(parts) == 2:
-        if parts[1] == 'weekly':
-            start_date = get_x_days_before(now, 7)
-        elif parts[1] == 'biweekly':
-            start_date = get_x_days_before(now, 14)
-        elif parts[1] == 'monthly':
-            start_date = get_x_days_before(now, 31)
-        elif parts[1] == 'all':
-            # Unbounded search for all dates
-            start_date = None
+    table, options, start_date, mode = parse_stats_request(update.message.text, now)
+
+    chat_id = get_group_chat_id(update.message)
+
+    if mode == "text":
+        message = generate_text_report_from(table, user, start_date, now, chat_id=chat_id, **options)
+        delete_message(bot, update.message.chat.id, update.message.message_id)
+        bot.send_message(chat_id=update.message.chat_id, text=message)
+        return
+
+    filename = "./{}-{}-chart.png".format(user.id, uuid.uuid4().hex)
+    if table in RATING_TABLES:
+        generate_linechart_report_from(table, filename, user, start_date, now)
     else:
-        # Default to a week ago
-        start_date = get_x_days_before(now, 7)
-
-    filename = "./{}-chart.png".format(user.id)
-    if command == "/meditatestats":
-        generate_timelog_report_from("meditation", filename, user, start_date, now)
-    elif command == "/anxietystats":
-        generate_linechart_report_from("anxiety", filename, user, start_date, now)
-    elif command == "/sleepstats":
-        generate_timelog_report_from("sleep", filename, user, start_date, now, calc_average=True)
-    elif command == "/groupstats":
-        generate_timelog_report_from("meditation", filename, user, start_date, now, all_data=True)
-    # synonyms as 'happinessstats' is weird AF
-    elif command == "/happinessstats" or command == "/happystats":
-        generate_linechart_report_from("happiness", filename, user, start_date, now)
-    elif command == "/fastingstats":
-        generate_timelog_report_from("fasting", filename, user, start_date, now)
+        generate_timelog_report_from(table, filename, user, start_date, now, chat_id=chat_id, **options)
 
     delete_message(bot, update.message.chat.id, update.message.message_id)
+    send_chart(bot, update.message.chat_id, filename)
 
+def send_chart(bot, chat_id, filename):
     with open(filename, 'rb') as photo:
-        bot.send_photo(chat_id=update.message.chat_id, photo=photo)
+        bot.send_photo(chat_id=chat_id, photo=photo)
     # Telegram API is synchronous, so it's OK to clean up now!
     os.remove(filename)
 
@@ -665,11 +1476,20 @@ def get_chart_x_limits(start_date, end_date, dates):
     upper_limit = end_date.date() if end_date else sorted_dates[-1]
     return [lower_limit, upper_limit]
 
-def generate_timelog_report_from(table, filename, user, start_date, end_date, all_data=False, calc_average=False):
+# pyplot keeps global state, and every tenant's dispatcher thread draws charts
+RENDER_LOCK = threading.Lock()
+
+def render(function, *args):
+    with RENDER_LOCK:
+        return function(*args)
+
+def generate_timelog_report_from(table, filename, user, start_date, end_date, all_data=False, calc_average=False, chat_id=None):
     user_id = None if all_data else user.id
     username = "Group" if all_data else get_name(user)
-    results = get_values(table, start_date=start_date, end_date=end_date, user_id=user_id)
+    results = get_values(table, start_date=start_date, end_date=end_date, user_id=user_id, chat_id=chat_id if all_data else None)
+    render(render_timelog_report, table, filename, username, results, start_date, end_date, calc_average)
 
+def render_timelog_report(table, filename, username, results, start_date, end_date, calc_average=False):
     dates_to_value_mapping = defaultdict(int)
     for result in results:
         dates_to_value_mapping[result[2].date()] += result[1]
@@ -712,6 +1532,9 @@ def generate_linechart_report_from(table, filename, user, start_date, end_date):
     user_id = user.id
     username = get_name(user)
     results = get_values(table, start_date=start_date, end_date=end_date, user_id=user_id)
+    render(render_linechart_report, table, filename, username, results, start_date, end_date)
+
+def render_linechart_report(table, filename, username, results, start_date, end_date):
     results = sorted(results, key=lambda x: x[2])
 
     ratings = [x[1] for x in results]
@@ -739,6 +1562,260 @@ def generate_linechart_report_from(table, filename, user, start_date, end_date):
     plt.savefig(filename)
     plt.close()
 
+INSIGHT_TABLES = ["meditation", "sleep", "fasting", "happiness", "anxiety"]
+# A day without a meditation or fast logged really was zero; a day without a rating is unknown
+INSIGHT_FILL = {"meditation": 0.0, "fasting": 0.0}
+INSIGHT_UNITS = {"meditation": " min", "sleep": " h", "fasting": " h", "happiness": "/10", "anxiety": "/10"}
+INSIGHT_EMOJI = {"meditation": "🙏", "sleep": "😴", "fasting": "🍽", "happiness": "🙂", "anxiety": "😅"}
+# (cause, effect, lag in days)
+INSIGHT_CORRELATIONS = [
+    ("meditation", "happiness", 1),
+    ("meditation", "anxiety", 1),
+    ("sleep", "happiness", 0),
+    ("sleep", "anxiety", 0),
+    ("fasting", "happiness", 0),
+]
+INSIGHT_ROLLING_WINDOW = 7
+INSIGHT_MIN_SAMPLES = 5
+
+def align_daily_series(series, start_day, end_day):
+    # Turn {table: {date: value}} into one array per table, indexed by day since start_day
+    days = np.arange(np.datetime64(start_day, 'D'), np.datetime64(end_day, 'D') + 1)
+    arrays = {}
+    for table, values in series.items():
+        array = np.full(len(days), INSIGHT_FILL.get(table, np.nan))
+        if values:
+            offsets = (np.array(list(values.keys()), dtype='datetime64[D]') - days[0]).astype(int)
+            in_range = (offsets >= 0) & (offsets < len(days))
+            array[offsets[in_range]] = np.array(list(values.values()))[in_range]
+        arrays[table] = array
+    return days, arrays
+
+def rolling_mean(values, window):
+    # NaN-aware trailing mean, computed with cumulative sums rather than a loop over windows
+    present = ~np.isnan(values)
+    sums = np.cumsum(np.where(present, values, 0.0))
+    counts = np.cumsum(present)
+    sums[window:] = sums[window:] - sums[:-window]
+    counts[window:] = counts[window:] - counts[:-window]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+def linear_trend(values):
+    # Least squares slope (units per day) over the days that have a value
+    present = ~np.isnan(values)
+    if present.sum() < 2:
+        return None
+    x = np.arange(len(values))[present]
+    y = values[present]
+    x_centered = x - x.mean()
+    denominator = (x_centered ** 2).sum()
+    if denominator == 0:
+        return None
+    return float((x_centered * (y - y.mean())).sum() / denominator)
+
+def lagged_correlation(cause, effect, lag):
+    # Pearson correlation between cause on day t and effect on day t + lag
+    if lag:
+        cause, effect = cause[:-lag], effect[lag:]
+    present = ~(np.isnan(cause) | np.isnan(effect))
+    samples = int(present.sum())
+    if samples < INSIGHT_MIN_SAMPLES:
+        return None, samples
+    cause, effect = cause[present], effect[present]
+    if cause.std() == 0 or effect.std() == 0:
+        return None, samples
+    return float(np.corrcoef(cause, effect)[0, 1]), samples
+
+def generate_insights_from(user, start_date, end_date):
+    series = get_daily_series(INSIGHT_TABLES, start_date=start_date, end_date=end_date, user_id=user.id)
+    return build_insights(get_name(user), series, start_date, end_date)
+
+def build_insights(username, series, start_date, end_date):
+    logged_days = [day for values in series.values() for day in values]
+    if not logged_days:
+        return None
+
+    start_day = start_date.date() if start_date else min(logged_days)
+    days, arrays = align_daily_series(series, start_day, end_date.date())
+
+    lines = ["📈 {}'s insights over {} days".format(username, len(days)), ""]
+    for table in INSIGHT_TABLES:
+        values = arrays[table]
+        if not series[table]:
+            continue
+        average = float(np.nanmean(values))
+        recent = rolling_mean(values, INSIGHT_ROLLING_WINDOW)[-1]
+        trend = linear_trend(values)
+        line = "{} {}: average {:.1f}{}".format(INSIGHT_EMOJI[table], table.title(), average, INSIGHT_UNITS[table])
+        if not np.isnan(recent):
+            line += ", last {} days {:.1f}{}".format(INSIGHT_ROLLING_WINDOW, recent, INSIGHT_UNITS[table])
+        if trend is not None:
+            line += ", trend {:+.2f}/day".format(trend)
+        lines.append(line)
+
+    correlation_lines = []
+    for cause, effect, lag in INSIGHT_CORRELATIONS:
+        correlation, samples = lagged_correlation(arrays[cause], arrays[effect], lag)
+        if correlation is None:
+            continue
+        when = "next-day" if lag == 1 else "same-day" if lag == 0 else "{}-day later".format(lag)
+        correlation_lines.append("🔗 {} vs {} {}: r = {:+.2f} ({} days)".format(cause.title(), when, effect, correlation, samples))
+
+    lines.append("")
+    if correlation_lines:
+        lines.extend(correlation_lines)
+    else:
+        lines.append("🔗 Not enough overlapping days yet to find correlations. Keep logging!")
+    return "\n".join(lines)
+
+def insights(bot, update):
+    get_or_create_user(bot, update)
+    parts = update.message.text.split(' ')
+    user = update.message.from_user
+
+    now = datetime.datetime.now()
+    start_date = get_period_start(parts[1] if len(parts) == 2 else 'monthly', now)
+    message = generate_insights_from(user, start_date, now)
+
+    delete_message(bot, update.message.chat.id, update.message.message_id)
+
+    if message is None:
+        bot.send_message(chat_id=update.message.chat.id, text="📈 {} hasn't logged anything in that period yet!".format(get_name(user)))
+        return
+    bot.send_message(chat_id=update.message.chat.id, text=message)
+
+SPARKLINE_BLOCKS = "▁▂▃▄▅▆▇█"
+SPARKLINE_WIDTH = 40
+TEXT_BAR_DAYS = 14
+TEXT_BAR_WIDTH = 12
+RATING_TABLES = ["happiness", "anxiety"]
+TABLE_UNITS = {"meditation": "minutes", "sleep": "hours", "fasting": "hours"}
+
+def downsample(values, width):
+    # Average neighbouring days so long periods still fit on one line
+    if len(values) <= width:
+        return values
+    edges = np.linspace(0, len(values), width + 1).astype(int)[:-1]
+    present = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(present, values, 0.0), edges)
+    counts = np.add.reduceat(present.astype(int), edges)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+def sparkline(values, top):
+    if top <= 0:
+        top = 1
+    levels = np.clip(np.nan_to_num(values) / top * (len(SPARKLINE_BLOCKS) - 1), 0, len(SPARKLINE_BLOCKS) - 1)
+    levels = np.rint(levels).astype(int)
+    return "".join(" " if np.isnan(value) else SPARKLINE_BLOCKS[level] for value, level in zip(values, levels))
+
+def text_bar(value, top):
+    if np.isnan(value):
+        return ""
+    return "█" * int(round(min(value / max(top, 1), 1) * TEXT_BAR_WIDTH))
+
+def generate_text_report_from(table, user, start_date, end_date, all_data=False, calc_average=False, chat_id=None):
+    user_id = None if all_data else user.id
+    username = "Group" if all_data else get_name(user)
+    series = get_daily_series([table], start_date=start_date, end_date=end_date, user_id=user_id, chat_id=chat_id if all_data else None)
+    return render_text_report(table, username, series, start_date, end_date, calc_average)
+
+def render_text_report(table, username, series, start_date, end_date, calc_average=False):
+    if not series[table]:
+        return "📊 {} has no {} entries in that period.".format(username, table)
+
+    start_day = start_date.date() if start_date else min(series[table])
+    days, arrays = align_daily_series(series, start_day, end_date.date())
+    values = arrays[table]
+    is_rating = table in RATING_TABLES
+    top = 10 if is_rating else float(np.nanmax(values))
+
+    if is_rating or calc_average:
+        summary_text = "Average: {:.1f}".format(float(np.nanmean(values)))
+    else:
+        summary_text = "Total: {:.1f} {} · Daily average: {:.1f}".format(float(np.nansum(values)), TABLE_UNITS[table], float(np.nanmean(values)))
+    highest = int(np.nanargmax(values))
+
+    lines = [
+        "📊 {}'s {} · {} days".format(username, table, len(days)),
+        sparkline(downsample(values, SPARKLINE_WIDTH), top),
+        "{} · Highest: {:.1f} on {}".format(summary_text, float(values[highest]), days[highest].astype(datetime.date).strftime('%d/%m')),
+    ]
+    if len(days) <= TEXT_BAR_DAYS:
+        lines.append("")
+        for day, value in zip(days, values):
+            shown = "-" if np.isnan(value) else "{:g}".format(round(float(value), 1))
+            lines.append("{} {} {}".format(day.astype(datetime.date).strftime('%a %d/%m'), text_bar(value, top), shown))
+    return "\n".join(lines)
+
+DASHBOARD_BAR_TABLES = ["meditation", "sleep", "fasting"]
+DASHBOARD_LINE_TABLES = ["happiness", "anxiety"]
+DASHBOARD_TABLES = DASHBOARD_BAR_TABLES + DASHBOARD_LINE_TABLES
+
+def generate_dashboard_from(filename, user, start_date, end_date):
+    # Every panel comes from the same daily series, so it's one query and one figure for the lot
+    series = get_daily_series(DASHBOARD_TABLES, start_date=start_date, end_date=end_date, user_id=user.id)
+    return render(render_dashboard, filename, get_name(user), series, start_date, end_date)
+
+def render_dashboard(filename, username, series, start_date, end_date):
+    logged_days = [day for values in series.values() for day in values]
+    if not logged_days:
+        return False
+
+    start_day = start_date.date() if start_date else min(logged_days)
+    days, arrays = align_daily_series(series, start_day, end_date.date())
+    dates = days.astype(datetime.date)
+    interval = len(days) - 1
+
+    figure, axes = plt.subplots(len(DASHBOARD_BAR_TABLES) + 1, 1, sharex=True, figsize=(8, 10))
+    for axis, table in zip(axes, DASHBOARD_BAR_TABLES):
+        values = np.nan_to_num(arrays[table])
+        axis.bar(dates, values, align='center', alpha=0.5)
+        axis.set_ylabel("{} ({})".format(table.title(), TABLE_UNITS[table]))
+
+    rating_axis = axes[-1]
+    for table in DASHBOARD_LINE_TABLES:
+        # Days without a rating leave a gap rather than dropping to zero
+        rating_axis.plot(dates, arrays[table], marker='.', label=table.title())
+    rating_axis.set_ylim([0, 10])
+    rating_axis.set_ylabel("Rating")
+    rating_axis.legend(loc='upper left')
+
+    rating_axis.set_xlim([dates[0], dates[-1]])
+    rating_axis.xaxis_date()
+    # Try to keep the ticks on the x axis readable by limiting to max of 10
+    if interval > 10:
+        rating_axis.xaxis.set_major_locator(mdates.DayLocator(interval=math.ceil(interval/10)))
+        rating_axis.xaxis.set_minor_locator(mdates.DayLocator())
+    else:
+        rating_axis.xaxis.set_major_locator(mdates.DayLocator())
+    rating_axis.xaxis.set_major_formatter(mdates.DateFormatter('%d/%m'))
+
+    axes[0].set_title('{}\'s dashboard\n{} days report'.format(username, interval))
+    figure.savefig(filename)
+    plt.close(figure)
+    return True
+
+def dashboard(bot, update):
+    get_or_create_user(bot, update)
+    parts = update.message.text.split(' ')
+    user = update.message.from_user
+
+    now = datetime.datetime.now()
+    start_date = get_period_start(parts[1] if len(parts) == 2 else None, now)
+
+    filename = "./{}-{}-dashboard.png".format(user.id, uuid.uuid4().hex)
+    has_data = generate_dashboard_from(filename, user, start_date, now)
+
+    delete_message(bot, update.message.chat.id, update.message.message_id)
+
+    if not has_data:
+        bot.send_message(chat_id=update.message.chat_id, text="📊 {} hasn't logged anything in that period yet!".format(get_name(user)))
+        return
+
+    send_chart(bot, update.message.chat_id, filename)
+
 def send_summary_email(bot, update):
     user = get_or_create_user(bot, update)
     cursor = get_connection().cursor()
@@ -801,116 +1878,574 @@ https://mindfulmakers.club/"
 
     server.quit()
 
+# asyncio runtime, enabled with ASYNC_MODE. Database access goes through a pool of psycopg2 async connections
+# driven by the event loop, Bot API calls (and the sync callbacks making them) run on an I/O executor, and
+# date parsing and chart rendering run on their own executors so they never block the loop.
+AIO_LOOP = None
+AIO_POOL = None
+IO_EXECUTOR = None
+CPU_EXECUTOR = None
+# pyplot keeps global state, so charts are rendered one at a time
+RENDER_EXECUTOR = None
+AIO_THREAD = None
+# Every tenant shares the loop, so each task remembers which tenant it's working for
+TASK_TENANTS = weakref.WeakKeyDictionary()
+# asyncio.current_task only arrived in Python 3.7, the Docker image is still on 3.6
+current_task = getattr(asyncio, 'current_task', None) or getattr(asyncio.Task, 'current_task')
+
+def start_async_runtime():
+    global AIO_LOOP, AIO_THREAD, IO_EXECUTOR, CPU_EXECUTOR, RENDER_EXECUTOR
+    AIO_LOOP = asyncio.new_event_loop()
+    AIO_LOOP.set_task_factory(create_task)
+    IO_EXECUTOR = ThreadPoolExecutor(max_workers=ASYNC_IO_WORKERS)
+    CPU_EXECUTOR = ThreadPoolExecutor(max_workers=ASYNC_CPU_WORKERS)
+    RENDER_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+    AIO_THREAD = threading.Thread(target=AIO_LOOP.run_forever, name="asyncio", daemon=True)
+    AIO_THREAD.start()
+    asyncio.run_coroutine_threadsafe(aio_create_pool(), AIO_LOOP).result()
+
+def create_task(loop, coroutine):
+    # Tasks started from another task (eg. by asyncio.gather) work for the same tenant
+    task = asyncio.Task(coroutine, loop=loop)
+    parent = current_task(loop)
+    if parent in TASK_TENANTS:
+        TASK_TENANTS[task] = TASK_TENANTS[parent]
+    return task
+
+async def aio_create_pool():
+    # Connections are opened lazily, the pool starts out as placeholders
+    global AIO_POOL
+    AIO_POOL = asyncio.Queue()
+    for _ in range(ASYNC_DB_POOL_SIZE):
+        AIO_POOL.put_nowait(None)
+
+def run_coroutine(coroutine):
+    future = asyncio.run_coroutine_threadsafe(with_tenant(get_tenant(), coroutine), AIO_LOOP)
+    future.add_done_callback(report_future_error)
+    return future
+
+async def with_tenant(tenant, coroutine):
+    TASK_TENANTS[current_task(AIO_LOOP)] = tenant
+    return await coroutine
+
+def report_future_error(future):
+    if future.cancelled() or future.exception() is None:
+        return
+    e = future.exception()
+    traceback.print_exception(type(e), e, e.__traceback__)
+
+def async_handler(handler, coroutine_function):
+    # The coroutine version of a handler when running in ASYNC_MODE, the plain one otherwise
+    if not ASYNC_MODE:
+        return handler
+
+    def run_async_handler(bot, update):
+        return run_coroutine(coroutine_function(bot, update))
+
+    return run_async_handler
+
+async def aio_call(function, *args, **kwargs):
+    # Sync callbacks reach the database through get_connection, so they carry the task's tenant over
+    tenant = get_tenant()
+
+    def call():
+        use_tenant(tenant)
+        return function(*args, **kwargs)
+
+    return await asyncio.get_event_loop().run_in_executor(IO_EXECUTOR, call)
+
+async def aio_cpu(function, *args):
+    return await asyncio.get_event_loop().run_in_executor(CPU_EXECUTOR, lambda: function(*args))
+
+async def aio_render(function, *args):
+    return await asyncio.get_event_loop().run_in_executor(RENDER_EXECUTOR, lambda: render(function, *args))
+
+async def aio_wait(conn):
+    loop = asyncio.get_event_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        future = loop.create_future()
+
+        def ready():
+            if not future.done():
+                future.set_result(None)
+
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(conn.fileno(), ready)
+            try:
+                await future
+            finally:
+                loop.remove_reader(conn.fileno())
+        else:
+            loop.add_writer(conn.fileno(), ready)
+            try:
+                await future
+            finally:
+                loop.remove_writer(conn.fileno())
+
+async def aio_connect():
+    conn = psycopg2.connect(
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        host=DB_HOST,
+        port="5432",
+        connect_timeout=DB_CONNECT_TIMEOUT,
+        async_=1
+    )
+    await aio_wait(conn)
+    return conn
+
+async def aio_query(query, params=None, timeout_ms=None):
+    # Async connections are always in autocommit, so every call is its own transaction
+    conn = await AIO_POOL.get()
+    try:
+        if conn is None or conn.closed:
+            conn = None
+            conn = await aio_connect()
+        if isinstance(query, str):
+            query = sql.SQL(query)
+        # Statements sent together run as one implicit transaction, so SET LOCAL still applies.
+        # The pool is shared by every tenant, each query picks its tenant's schema.
+        search_path = sql.SQL("SET LOCAL search_path TO {}; ").format(sql.Identifier(get_tenant()))
+        statement = query
+        if timeout_ms:
+            statement = sql.SQL("SET LOCAL statement_timeout = {}; {}").format(sql.Literal(timeout_ms), statement)
+        cursor = conn.cursor()
+        # Includes any time spent waiting for the loop, which is what the handler saw too
+        started = time.perf_counter()
+        try:
+            cursor.execute(search_path + statement, params)
+            await aio_wait(conn)
+        except psycopg2.Error as e:
+            await aio_check_slow_query(conn, search_path, query, params, started, error=e)
+            raise
+        rows = cursor.fetchall() if cursor.description else None
+        rowcount = cursor.rowcount
+        cursor.close()
+        await aio_check_slow_query(conn, search_path, query, params, started, rowcount)
+        return rows
+    except BaseException:
+        # A connection abandoned mid-statement (eg. a cancelled task) can't be reused
+        if conn is not None and not conn.closed and conn.isexecuting():
+            conn.close()
+        raise
+    finally:
+        AIO_POOL.put_nowait(conn)
+
+async def aio_check_slow_query(conn, search_path, query, params, started, rowcount=-1, error=None):
+    # Same as check_slow_query, async connections are in autocommit so the EXPLAIN needs the schema again
+    duration_ms = (time.perf_counter() - started) * 1000
+    if duration_ms < SLOW_QUERY_MS:
+        return
+    query_text = query.as_string(conn)
+    plan = None
+    explain = explain_query(query, query_text)
+    if error is None and explain is not None and random.random() < SLOW_QUERY_EXPLAIN_RATE:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(search_path + explain, params)
+            await aio_wait(conn)
+            plan = [row[0] for row in cursor.fetchall()]
+        except psycopg2.Error as e:
+            plan = ["EXPLAIN failed: {}".format(e)]
+        finally:
+            cursor.close()
+    log_slow_query(query_text, params, duration_ms, rowcount, plan, error)
+
+async def aio_get_or_create_user(bot, update, timeout_ms=None):
+    user = update.message.from_user
+    rows = await aio_query('SELECT * FROM users WHERE id = %s', (user.id,), timeout_ms=timeout_ms)
+    if not rows:
+        has_pm = update.message.chat_id == user.id
+        inserted = await aio_query("INSERT INTO users(id, first_name, last_name, username, haspm) VALUES (%s, %s, %s, %s, %s) "\
+                                   "ON CONFLICT (id) DO NOTHING RETURNING id",
+                                   (user.id, user.first_name, user.last_name, user.username, has_pm), timeout_ms=timeout_ms)
+        # If command was run in public, ask them to PM us!
+        if inserted and not has_pm:
+            await aio_call(bot.send_message, chat_id=update.message.chat_id, text="Hey {}! Please message me at @zenafbot so that I can PM you!".format(get_name(user)))
+        rows = await aio_query('SELECT * FROM users WHERE id = %s', (user.id,), timeout_ms=timeout_ms)
+
+    member = get_chat_member(update.message)
+    if member and member not in SEEN_CHAT_MEMBERS:
+        await aio_query(CHAT_MEMBER_INSERT, member[1:], timeout_ms=timeout_ms)
+        SEEN_CHAT_MEMBERS.add(member)
+    return rows[0]
+
+async def aio_get_streak_of(user_id):
+    rows = await aio_query(STREAK_QUERY, (user_id,))
+    return rows[0][0]
+
+async def aio_get_daily_series(tables, start_date=None, end_date=None, user_id=None, chat_id=None):
+    rows = await aio_query(*daily_series_query(tables, start_date, end_date, user_id, chat_id))
+    return series_from_rows(tables, rows)
+
+async def aio_save_entry(table, user, value, backdate=None, try_database=True):
+    # Same as save_entry: spool to disk when the database is down, slow, or still has a backlog
+    if try_database and not has_spooled_writes():
+        try:
+            await aio_query(*insert_query(table, user.id, value, backdate), timeout_ms=DB_WRITE_TIMEOUT_MS)
+            return True
+        except DB_UNAVAILABLE_ERRORS as e:
+            print("Spooling write to {}: {}".format(table, e))
+    await aio_call(append_to_spool, make_spool_entry(table, user, value, backdate))
+    return False
+
+async def aio_send_chart(bot, chat_id, filename):
+    await aio_call(send_chart, bot, chat_id, filename)
+
+async def aio_delete_and_send(bot, update, validation_callback, success_callback, strings, backdate=None):
+    message = update.message
+    try:
+        await aio_get_or_create_user(bot, update, timeout_ms=DB_WRITE_TIMEOUT_MS)
+        database_ok = True
+    except DB_UNAVAILABLE_ERRORS:
+        # Still take the entry, the user is created when the spool is replayed
+        database_ok = False
+    #No command needs parts[0] as it's just the name of the command to be executed.
+    parts = message.text.split(' ')[1:]
+    if len(parts) < 1:
+        await aio_call(bot.send_message, chat_id=message.from_user.id, text=strings["wrong_length"])
+        return
+
+    if len(parts) > 1:
+        # Only a trailing word can be a backdate, and dateparser is too slow to run on the loop
+        parts, backdate, backdate_err = await aio_cpu(split_backdate, parts, backdate)
+    else:
+        backdate_err = None
+    if backdate_err:
+        await aio_call(bot.send_message, chat_id=message.from_user.id, text=backdate_err)
+        return
+
+    # The callbacks are plain functions that call the Bot API themselves
+    try:
+        value = await aio_call(validation_callback, parts)
+        if value is False:
+            return
+    except ValueError:
+        await aio_call(bot.send_message, chat_id=message.from_user.id, text=strings["value_error"])
+        return
+
+    saved = await aio_save_entry(strings["table_name"], message.from_user, value, backdate, try_database=database_ok)
+
+    historic_date = "" if backdate is None else " on " + backdate.date().isoformat()
+
+    def finish():
+        delete_message(bot, message.chat.id, message.message_id)
+        success_callback(get_name(message.from_user), value, update, historic_date, saved)
+
+    # One trip to the executor for both Bot API calls
+    await aio_call(finish)
+
+async def aio_streak(bot, update):
+    await aio_get_or_create_user(bot, update)
+    message = update.message
+    streak = await aio_get_streak_of(message.from_user.id)
+    emoji = get_streak_emoji(streak)
+
+    await aio_call(delete_message, bot, message.chat.id, message.message_id)
+
+    name_to_show = get_name(message.from_user)
+    await aio_call(bot.send_message, chat_id=message.chat.id, text="{} has a meditation streak of {}! {}".format(name_to_show, streak, emoji))
+
+async def aio_top(bot, update):
+    await aio_get_or_create_user(bot, update)
+    message = update.message
+    count = get_top_count(message.text.split(" "))
+
+    users = await aio_query(*chat_users_query(get_group_chat_id(message)))
+    # Every streak is its own query, so run them side by side over the pool
+    streaks = await asyncio.gather(*[aio_get_streak_of(user[0]) for user in users])
+    results = [(user[1], user[2], user[3], streak) for user, streak in zip(users, streaks)]
+
+    text = format_leaderboard(results, count)
+    await aio_call(delete_message, bot, message.chat.id, message.message_id)
+    await aio_call(bot.send_message, chat_id=message.chat_id, text=text)
+
+async def aio_stats(bot, update):
+    await aio_get_or_create_user(bot, update)
+    message = update.message
+    user = message.from_user
+    now = datetime.datetime.now()
+    table, options, start_date, mode = parse_stats_request(message.text, now)
+    all_data = options.get("all_data", False)
+    calc_average = options.get("calc_average", False)
+    user_id = None if all_data else user.id
+    chat_id = get_group_chat_id(message) if all_data else None
+    username = "Group" if all_data else get_name(user)
+
+    if mode == "text":
+        series = await aio_get_daily_series([table], start_date, now, user_id, chat_id)
+        # Vectorised over the daily series, quick enough to do on the loop
+        text = render_text_report(table, username, series, start_date, now, calc_average)
+        await aio_call(delete_message, bot, message.chat.id, message.message_id)
+        await aio_call(bot.send_message, chat_id=message.chat_id, text=text)
+        return
+
+    rows = await aio_query(*values_query(table, start_date, now, user_id, chat_id=chat_id))
+    # Several charts for the same user can be in flight at once
+    filename = "./{}-{}-chart.png".format(user.id, uuid.uuid4().hex)
+    if table in RATING_TABLES:
+        await aio_render(render_linechart_report, table, filename, username, rows, start_date, now)
+    else:
+        await aio_render(render_timelog_report, table, filename, username, rows, start_date, now, calc_average)
+
+    await aio_call(delete_message, bot, message.chat.id, message.message_id)
+    await aio_send_chart(bot, message.chat_id, filename)
+
+async def aio_insights(bot, update):
+    await aio_get_or_create_user(bot, update)
+    message = update.message
+    user = message.from_user
+    parts = message.text.split(' ')
+
+    now = datetime.datetime.now()
+    start_date = get_period_start(parts[1] if len(parts) == 2 else 'monthly', now)
+    series = await aio_get_daily_series(INSIGHT_TABLES, start_date, now, user.id)
+    # Vectorised over the daily series, quick enough to do on the loop
+    text = build_insights(get_name(user), series, start_date, now)
+
+    await aio_call(delete_message, bot, message.chat.id, message.message_id)
+
+    if text is None:
+        text = "📈 {} hasn't logged anything in that period yet!".format(get_name(user))
+    await aio_call(bot.send_message, chat_id=message.chat.id, text=text)
+
+async def aio_dashboard(bot, update):
+    await aio_get_or_create_user(bot, update)
+    message = update.message
+    user = message.from_user
+    parts = message.text.split(' ')
+
+    now = datetime.datetime.now()
+    start_date = get_period_start(parts[1] if len(parts) == 2 else None, now)
+    series = await aio_get_daily_series(DASHBOARD_TABLES, start_date, now, user.id)
+    filename = "./{}-{}-dashboard.png".format(user.id, uuid.uuid4().hex)
+    has_data = await aio_render(render_dashboard, filename, get_name(user), series, start_date, now)
+
+    await aio_call(delete_message, bot, message.chat.id, message.message_id)
+
+    if not has_data:
+        await aio_call(bot.send_message, chat_id=message.chat_id, text="📊 {} hasn't logged anything in that period yet!".format(get_name(user)))
+        return
+    await aio_send_chart(bot, message.chat_id, filename)
+
+async def aio_summary(bot, update):
+    await aio_get_or_create_user(bot, update)
+    message = update.message
+    parts = message.text.split(" ")
+    await aio_call(delete_message, bot, message.chat.id, message.message_id)
+
+    if len(parts) != 2:
+        await aio_call(bot.send_message, chat_id=message.from_user.id, text="📧 Please give your email address or `off`!")
+        return
+
+    if parts[1] == "now":
+        # SMTP is blocking from start to finish
+        await aio_call(send_summary_email, bot, update)
+        return
+
+    if parts[1] == "off":
+        await aio_query('DELETE FROM summary WHERE id = %s', (message.from_user.id,))
+        await aio_call(bot.send_message, chat_id=message.from_user.id, text="📧 Okay, you'll no longer receive weekly summaries!")
+        return
+
+    checked_addr = parseaddr(parts[1])[1]
+
+    if "@" not in checked_addr:
+        await aio_call(bot.send_message, chat_id=message.from_user.id, text="📧 It doesn't seem like your email address ({}) is valid!".format(checked_addr,))
+        return
+
+    await aio_query("INSERT INTO summary (id, email) VALUES (%s, %s) ON CONFLICT (id) DO UPDATE SET email = %s", (message.from_user.id, checked_addr, checked_addr))
+    await aio_call(bot.send_message, chat_id=message.from_user.id, text="📧 Great! You'll start receiving summaries to {}".format(checked_addr,))
+
+async def aio_importhistory(bot, update):
+    # Downloading and COPYing block from start to finish, keep them off the dispatcher thread
+    await aio_call(importhistory, bot, update)
+
 # Returns number of seconds until xx:00:00.
 # If currently 11:43:23, then should return 37 + 60 * 16
 def time_until_next_hour():
     now = datetime.datetime.now()
     return (60 - now.second) + 60 * (60 - now.minute)
 
+def create_tables():
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    cursor.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(sql.Identifier(get_tenant())))
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS users(\
+        id INTEGER UNIQUE NOT NULL,\
+        first_name text NOT NULL,\
+        last_name text,\
+        username text,\
+        haspm boolean DEFAULT FALSE\
+    );")
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS meditation(\
+        id INTEGER NOT NULL REFERENCES users(id),\
+        value INTEGER NOT NULL,\
+        created_at TIMESTAMP NOT NULL DEFAULT now()\
+    );")
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS meditationreminders(\
+        id INTEGER NOT NULL REFERENCES users(id),\
+        value INTEGER NOT NULL,\
+        midnight INTEGER NOT NULL,\
+        created_at TIMESTAMP NOT NULL DEFAULT now()\
+    );")
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS anxiety(\
+        id INTEGER NOT NULL REFERENCES users(id),\
+        value INTEGER NOT NULL,\
+        created_at TIMESTAMP NOT NULL DEFAULT now()\
+    );")
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS sleep(\
+        id INTEGER NOT NULL REFERENCES users(id),\
+        value REAL NOT NULL,\
+        created_at TIMESTAMP NOT NULL DEFAULT now()\
+    );")
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS fasting(\
+        id INTEGER NOT NULL REFERENCES users(id),\
+        value REAL NOT NULL,\
+        created_at TIMESTAMP NOT NULL DEFAULT now()\
+    );")
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS happiness(\
+        id INTEGER NOT NULL REFERENCES users(id),\
+        value INTEGER NOT NULL,\
+        created_at TIMESTAMP NOT NULL DEFAULT now()\
+    );")
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS journal(\
+        id INTEGER NOT NULL REFERENCES users(id),\
+        value varchar(4096) NOT NULL,\
+        created_at TIMESTAMP NOT NULL DEFAULT now()\
+    );")
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS exercise(\
+        id INTEGER NOT NULL REFERENCES users(id),\
+        value varchar(4096) NOT NULL,\
+        created_at TIMESTAMP NOT NULL DEFAULT now()\
+    );")
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS done(\
+        id INTEGER NOT NULL REFERENCES users(id),\
+        value varchar(4096) NOT NULL,\
+        created_at TIMESTAMP NOT NULL DEFAULT now()\
+    );")
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS summary(\
+        id INTEGER UNIQUE NOT NULL REFERENCES users(id),\
+        email varchar(128) NOT NULL,\
+        last_emailed TIMESTAMP NOT NULL DEFAULT 'epoch',\
+        created_at TIMESTAMP NOT NULL DEFAULT now()\
+    );")
+
+    # The primary key doubles as the index for looking up a chat's members
+    cursor.execute("CREATE TABLE IF NOT EXISTS chat_members(\
+        chat_id BIGINT NOT NULL,\
+        user_id INTEGER NOT NULL REFERENCES users(id),\
+        created_at TIMESTAMP NOT NULL DEFAULT now(),\
+        PRIMARY KEY (chat_id, user_id)\
+    );")
+
+    # Streaks and group stats look up a set of users' meditations rather than scanning everyone's
+    cursor.execute("CREATE INDEX IF NOT EXISTS meditation_id_created_at ON meditation (id, created_at);")
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS spoolapplied(\
+        key varchar(32) PRIMARY KEY,\
+        created_at TIMESTAMP NOT NULL DEFAULT now()\
+    );")
+
+    conn.commit()
+    cursor.close()
+
+def get_tenants():
+    # tenant -> bot token
+    if BOT_TOKENS is None:
+        return {DEFAULT_TENANT: os.environ.get('BOT_TOKEN', None)}
+    tenants = {}
+    for pair in BOT_TOKENS.split(","):
+        tenant, _, token = pair.strip().partition("=")
+        # Tenant names double as schema names
+        if not re.match(r'^[a-z_][a-z0-9_]*$', tenant) or not token:
+            raise Exception('BOT_TOKENS should look like `name=token,othername=othertoken`')
+        tenants[tenant] = token
+    return tenants
+
+def add_handlers(dispatcher, tenant):
+    def select_tenant(bot, update):
+        # Runs before the handlers below for every update, so they work in this tenant's schema
+        use_tenant(tenant)
+
+    dispatcher.add_handler(TypeHandler(Update, select_tenant), group=-1)
+    dispatcher.add_handler(CommandHandler('anxiety', admitted(anxiety, COST_CHEAP)))
+    dispatcher.add_handler(CommandHandler('anxietystats', admitted(async_handler(stats, aio_stats), COST_EXPENSIVE)))
+    dispatcher.add_handler(CommandHandler('dashboard', admitted(async_handler(dashboard, aio_dashboard), COST_EXPENSIVE)))
+    dispatcher.add_handler(CommandHandler('done', admitted(done, COST_CHEAP)))
+    dispatcher.add_handler(CommandHandler('exercise', admitted(exercise, COST_CHEAP)))
+    dispatcher.add_handler(CommandHandler('fast', admitted(fasting, COST_CHEAP)))
+    dispatcher.add_handler(CommandHandler('fasting', admitted(fasting, COST_CHEAP)))
+    dispatcher.add_handler(CommandHandler('fastingstats', admitted(async_handler(stats, aio_stats), COST_EXPENSIVE)))
+    dispatcher.add_handler(CommandHandler('groupstats', admitted(async_handler(stats, aio_stats), COST_EXPENSIVE, shared=True)))
+    dispatcher.add_handler(CommandHandler('happinessstats', admitted(async_handler(stats, aio_stats), COST_EXPENSIVE)))
+    dispatcher.add_handler(CommandHandler('happiness', admitted(happiness, COST_CHEAP)))
+    dispatcher.add_handler(CommandHandler('happystats', admitted(async_handler(stats, aio_stats), COST_EXPENSIVE)))
+    dispatcher.add_handler(CommandHandler('help', admitted(help_message, COST_CHEAP)))
+    dispatcher.add_handler(CommandHandler('import', admitted(importhistory, COST_CHEAP)))
+    dispatcher.add_handler(CommandHandler('insights', admitted(async_handler(insights, aio_insights), COST_EXPENSIVE)))
+    dispatcher.add_handler(CommandHandler('journal', admitted(journaladd, COST_CHEAP)))
+    dispatcher.add_handler(CommandHandler('journalentries', admitted(journallookup, COST_MODERATE)))
+    dispatcher.add_handler(CommandHandler('meditate', admitted(meditate, COST_CHEAP)))
+    dispatcher.add_handler(CommandHandler('meditation', admitted(meditate, COST_CHEAP)))
+    dispatcher.add_handler(CommandHandler('meditatestats', admitted(async_handler(stats, aio_stats), COST_EXPENSIVE)))
+    dispatcher.add_handler(CommandHandler('reminders', admitted(schedulereminders, COST_CHEAP)))
+    dispatcher.add_handler(CommandHandler('rest', admitted(rest, COST_CHEAP)))
+    dispatcher.add_handler(CommandHandler('sleep', admitted(sleep, COST_CHEAP)))
+    dispatcher.add_handler(CommandHandler('sleepstats', admitted(async_handler(stats, aio_stats), COST_EXPENSIVE)))
+    dispatcher.add_handler(CommandHandler('streak', admitted(async_handler(streak, aio_streak), COST_MODERATE)))
+    dispatcher.add_handler(CommandHandler('summary', admitted(async_handler(summary, aio_summary), COST_EXPENSIVE)))
+    dispatcher.add_handler(CommandHandler('top', admitted(async_handler(top, aio_top), COST_EXPENSIVE, shared=True)))
+    # Before pm, which would otherwise take every file sent in private
+    dispatcher.add_handler(MessageHandler(Filters.private & Filters.document, admitted(async_handler(importhistory, aio_importhistory), COST_EXPENSIVE)))
+    dispatcher.add_handler(MessageHandler(Filters.private, admitted(pm, COST_CHEAP)))
+
 #######################################################################################
 
-cursor = get_connection().cursor()
-
-cursor.execute("CREATE TABLE IF NOT EXISTS users(\
-    id INTEGER UNIQUE NOT NULL,\
-    first_name text NOT NULL,\
-    last_name text,\
-    username text,\
-    haspm boolean DEFAULT FALSE\
-);")
-
-cursor.execute("CREATE TABLE IF NOT EXISTS meditation(\
-    id INTEGER NOT NULL REFERENCES users(id),\
-    value INTEGER NOT NULL,\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-cursor.execute("CREATE TABLE IF NOT EXISTS meditationreminders(\
-    id INTEGER NOT NULL REFERENCES users(id),\
-    value INTEGER NOT NULL,\
-    midnight INTEGER NOT NULL,\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-cursor.execute("CREATE TABLE IF NOT EXISTS anxiety(\
-    id INTEGER NOT NULL REFERENCES users(id),\
-    value INTEGER NOT NULL,\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-cursor.execute("CREATE TABLE IF NOT EXISTS sleep(\
-    id INTEGER NOT NULL REFERENCES users(id),\
-    value REAL NOT NULL,\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-cursor.execute("CREATE TABLE IF NOT EXISTS fasting(\
-    id INTEGER NOT NULL REFERENCES users(id),\
-    value REAL NOT NULL,\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-cursor.execute("CREATE TABLE IF NOT EXISTS happiness(\
-    id INTEGER NOT NULL REFERENCES users(id),\
-    value INTEGER NOT NULL,\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-cursor.execute("CREATE TABLE IF NOT EXISTS journal(\
-    id INTEGER NOT NULL REFERENCES users(id),\
-    value varchar(4096) NOT NULL,\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-cursor.execute("CREATE TABLE IF NOT EXISTS exercise(\
-    id INTEGER NOT NULL REFERENCES users(id),\
-    value varchar(4096) NOT NULL,\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-cursor.execute("CREATE TABLE IF NOT EXISTS done(\
-    id INTEGER NOT NULL REFERENCES users(id),\
-    value varchar(4096) NOT NULL,\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-cursor.execute("CREATE TABLE IF NOT EXISTS summary(\
-    id INTEGER UNIQUE NOT NULL REFERENCES users(id),\
-    email varchar(128) NOT NULL,\
-    last_emailed TIMESTAMP NOT NULL DEFAULT 'epoch',\
-    created_at TIMESTAMP NOT NULL DEFAULT now()\
-);")
-
-get_connection().commit()
-cursor.close()
-
-DISPATCHER.add_handler(CommandHandler('anxiety', anxiety))
-DISPATCHER.add_handler(CommandHandler('anxietystats', stats))
-DISPATCHER.add_handler(CommandHandler('done', done))
-DISPATCHER.add_handler(CommandHandler('exercise', exercise))
-DISPATCHER.add_handler(CommandHandler('fast', fasting))
-DISPATCHER.add_handler(CommandHandler('fasting', fasting))
-DISPATCHER.add_handler(CommandHandler('fastingstats', stats))
-DISPATCHER.add_handler(CommandHandler('groupstats', stats))
-DISPATCHER.add_handler(CommandHandler('happinessstats', stats))
-DISPATCHER.add_handler(CommandHandler('happiness', happiness))
-DISPATCHER.add_handler(CommandHandler('happystats', stats))
-DISPATCHER.add_handler(CommandHandler('help', help_message))
-DISPATCHER.add_handler(CommandHandler('journal', journaladd))
-DISPATCHER.add_handler(CommandHandler('journalentries', journallookup))
-DISPATCHER.add_handler(CommandHandler('meditate', meditate))
-DISPATCHER.add_handler(CommandHandler('meditation', meditate))
-DISPATCHER.add_handler(CommandHandler('meditatestats', stats))
-DISPATCHER.add_handler(CommandHandler('reminders', schedulereminders))
-DISPATCHER.add_handler(CommandHandler('rest', rest))
-DISPATCHER.add_handler(CommandHandler('sleep', sleep))
-DISPATCHER.add_handler(CommandHandler('sleepstats', stats))
-DISPATCHER.add_handler(CommandHandler('streak', streak))
-DISPATCHER.add_handler(CommandHandler('summary', summary))
-DISPATCHER.add_handler(CommandHandler('top', top))
-DISPATCHER.add_handler(MessageHandler(Filters.private, pm))
-
-JOBQUEUE.run_repeating(executereminders, interval=3600, first=time_until_next_hour()+10)
-
-UPDATER.start_polling()
-UPDATER.idle()
+TENANTS = get_tenants()
+for name in TENANTS:
+    use_tenant(name)
+    create_tables()
+
+if len(sys.argv) > 1 and sys.argv[1] == "import":
+    import_history_cli(sys.argv[2:])
+    sys.exit()
+
+if None in TENANTS.values():
+    raise Exception('No Token!')
+
+if ASYNC_MODE:
+    start_async_runtime()
+
+# One Updater per bot, they share the database connections, the async runtime and the render lock
+UPDATERS = []
+for name, token in TENANTS.items():
+    updater = Updater(token=token, base_url=BOT_API_URL)
+    add_handlers(updater.dispatcher, name)
+    updater.job_queue.run_repeating(executereminders, interval=3600, first=time_until_next_hour()+10, context=name)
+    UPDATERS.append(updater)
+
+# The spool holds every tenant's writes, so one job replays them all
+UPDATERS[0].job_queue.run_repeating(replay_spool, interval=SPOOL_REPLAY_INTERVAL, first=0)
+
+for updater in UPDATERS:
+    updater.start_polling()
+UPDATERS[0].idle()
+for updater in UPDATERS[1:]:
+    updater.stop()
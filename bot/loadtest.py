@@ -0,0 +1,388 @@
+"""End-to-end load test for the bot.
+
+Runs a fake Bot API server on localhost, starts bot.py against it (through
+BOT_API_URL) and the Postgres given by the usual DB_* variables, then has
+thousands of simulated users send a mix of commands and reports updates/sec
+and reply latency percentiles.
+
+    python loadtest.py --users 2000 --duration 60
+    python loadtest.py --mix meditate=5,top=1 --think 1.5
+
+Each simulated user has one command in flight at a time: an update is served
+through getUpdates and the first sendMessage/sendPhoto to that user's chat
+counts as the reply. Simulated users get ids from 1000000000 up and are
+created with haspm set, so the "please PM me" nudge doesn't skew the results.
+The spawned bot gets admission budgets too large to ever throttle anyone,
+unless the ADMISSION_* variables are set. Throttle notices are then reported
+as their own category rather than as replies. A throttled command without a
+notice (there's one per user per minute) still shows up as a timeout.
+"""
+import argparse
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import random
+import re
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import parse_qsl, urlparse
+
+import psycopg2
+
+FAKE_TOKEN = '123456789:loadtest'
+FIRST_USER_ID = 1000000000
+MAX_UPDATES_PER_POLL = 100
+# How admitted() in bot.py starts the PM it sends a throttled user
+THROTTLE_NOTICE = '🐢 Easy there!'
+# Budgets for the spawned bot that no simulated user can run out of
+UNLIMITED_ADMISSION = {
+    'ADMISSION_USER_CAPACITY': '1000000000',
+    'ADMISSION_USER_REFILL': '1000000000',
+    'ADMISSION_CHAT_CAPACITY': '1000000000',
+    'ADMISSION_CHAT_REFILL': '1000000000',
+}
+
+# command -> function building the message text
+COMMANDS = {
+    'meditate': lambda: '/meditate {}'.format(random.randint(5, 60)),
+    'happiness': lambda: '/happiness {}'.format(random.randint(0, 10)),
+    'anxiety': lambda: '/anxiety {}'.format(random.randint(0, 10)),
+    'sleep': lambda: '/sleep {:.1f}'.format(random.uniform(4, 10)),
+    'fasting': lambda: '/fasting {:.1f}'.format(random.uniform(10, 24)),
+    'journal': lambda: '/journal Load test entry {}'.format(random.randint(0, 1000000)),
+    'exercise': lambda: '/exercise ran {}km'.format(random.randint(1, 20)),
+    'streak': lambda: '/streak',
+    'meditatestats': lambda: '/meditatestats {}'.format(random.choice(['weekly', 'monthly'])),
+    'meditatestats_text': lambda: '/meditatestats weekly text',
+    'happystats': lambda: '/happystats weekly',
+    'insights': lambda: '/insights monthly',
+    'dashboard': lambda: '/dashboard weekly',
+    'top': lambda: '/top 5',
+    'groupstats': lambda: '/groupstats weekly',
+}
+DEFAULT_MIX = 'meditate=30,happiness=10,anxiety=10,sleep=10,journal=5,exercise=5,streak=10,'\
+              'meditatestats=3,meditatestats_text=5,happystats=2,insights=3,dashboard=2,top=3,groupstats=2'
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeBotAPI:
+    """Serves scripted updates through getUpdates and records what the bot sends back."""
+
+    def __init__(self, reply_timeout):
+        self.reply_timeout = reply_timeout
+        self.condition = threading.Condition()
+        self.pending_updates = deque()
+        self.next_update_id = 1
+        self.next_message_id = 1
+        # chat id -> (time the update was served, command)
+        self.in_flight = {}
+        self.ready_users = deque()
+        self.latencies = defaultdict(list)
+        self.timeouts = defaultdict(int)
+        self.throttled = defaultdict(int)
+        self.calls = defaultdict(int)
+        self.measuring = False
+
+    def push_command(self, user_id, command, text):
+        with self.condition:
+            update_id = self.next_update_id
+            self.next_update_id += 1
+            self.pending_updates.append((update_id, user_id, command, text))
+            self.condition.notify_all()
+
+    def get_updates(self, offset, limit, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.pending_updates and self.pending_updates[0][0] < offset:
+                self.pending_updates.popleft()
+            while not self.pending_updates and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+
+            now = time.monotonic()
+            updates = []
+            for update_id, user_id, command, text in list(self.pending_updates)[:limit]:
+                if user_id not in self.in_flight:
+                    self.in_flight[user_id] = (now, command)
+                updates.append(make_update(update_id, user_id, self.next_message_id, text))
+                self.next_message_id += 1
+            return updates
+
+    def record_call(self, method, chat_id, text=''):
+        now = time.monotonic()
+        with self.condition:
+            self.calls[method] += 1
+            if method not in ('sendMessage', 'sendPhoto') or chat_id not in self.in_flight:
+                return
+            served_at, command = self.in_flight.pop(chat_id)
+            if self.measuring:
+                if text.startswith(THROTTLE_NOTICE):
+                    self.throttled[command] += 1
+                else:
+                    self.latencies[command].append(now - served_at)
+            self.ready_users.append(chat_id)
+
+    def expire_in_flight(self):
+        now = time.monotonic()
+        with self.condition:
+            for user_id, (served_at, command) in list(self.in_flight.items()):
+                if now - served_at > self.reply_timeout:
+                    del self.in_flight[user_id]
+                    if self.measuring:
+                        self.timeouts[command] += 1
+                    self.ready_users.append(user_id)
+
+    def take_ready_users(self):
+        with self.condition:
+            users = list(self.ready_users)
+            self.ready_users.clear()
+            return users
+
+    def next_message(self):
+        with self.condition:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            return message_id
+
+
+def make_user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': 'Load', 'last_name': str(user_id), 'username': 'load{}'.format(user_id)}
+
+
+def make_update(update_id, user_id, message_id, text):
+    command_length = len(text.split(' ')[0])
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': make_user(user_id),
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': command_length}],
+        },
+    }
+
+
+def parse_params(headers, body):
+    content_type = headers.get('Content-Type', '')
+    if content_type.startswith('application/json'):
+        return json.loads(body.decode('utf-8') or '{}')
+    if content_type.startswith('multipart/form-data'):
+        # Only the plain fields matter, the photo itself is thrown away
+        fields = re.findall(rb'name="(\w+)"\r\n(?:[^\r\n]+\r\n)*\r\n([^\r\n]*)\r\n', body)
+        return {name.decode(): value.decode('utf-8', 'replace') for name, value in fields if name != b'photo'}
+    return dict(parse_qsl(body.decode('utf-8')))
+
+
+def make_handler(api):
+    class BotAPIHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self.handle_method(dict(parse_qsl(urlparse(self.path).query)))
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            self.handle_method(parse_params(self.headers, self.rfile.read(length)))
+
+        def handle_method(self, params):
+            method = urlparse(self.path).path.rsplit('/', 1)[-1]
+            if method == 'getUpdates':
+                api.record_call(method, None)
+                result = api.get_updates(int(params.get('offset', 0)), int(params.get('limit', MAX_UPDATES_PER_POLL)), float(params.get('timeout', 0)))
+            elif method == 'getMe':
+                result = {'id': 123456789, 'is_bot': True, 'first_name': 'Load test', 'username': 'zenafbot'}
+            elif method in ('sendMessage', 'sendPhoto'):
+                chat_id = int(params.get('chat_id', 0))
+                api.record_call(method, chat_id, params.get('text', ''))
+                result = {
+                    'message_id': api.next_message(),
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                }
+                if method == 'sendMessage':
+                    result['text'] = params.get('text', '')
+                else:
+                    result['photo'] = []
+            else:
+                api.record_call(method, None)
+                result = True
+
+            body = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return BotAPIHandler
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        command, weight = part.split('=')
+        if command not in COMMANDS:
+            raise SystemExit('Unknown command in mix: {} (known: {})'.format(command, ', '.join(sorted(COMMANDS))))
+        weights[command] = float(weight)
+    return list(weights), list(weights.values())
+
+
+def get_connection():
+    return psycopg2.connect(
+        dbname=os.environ.get('DB_NAME', 'zenirlbot'),
+        user=os.environ.get('DB_USER', 'postgres'),
+        password=os.environ.get('DB_PASSWORD', 'password'),
+        host=os.environ.get('DB_HOST', 'localhost'),
+        port="5432"
+    )
+
+
+def seed_users(user_ids):
+    conn = get_connection()
+    cursor = conn.cursor()
+    for user_id in user_ids:
+        user = make_user(user_id)
+        cursor.execute("INSERT INTO users(id, first_name, last_name, username, haspm) VALUES (%s, %s, %s, %s, TRUE) ON CONFLICT (id) DO NOTHING",
+                       (user_id, user['first_name'], user['last_name'], user['username']))
+    conn.commit()
+    conn.close()
+
+
+def cleanup_users(user_ids):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT table_name FROM information_schema.columns WHERE column_name = 'id' AND table_schema = current_schema() AND table_name != 'users'")
+    tables = [row[0] for row in cursor.fetchall()]
+    for table in tables:
+        cursor.execute('DELETE FROM "{}" WHERE id = ANY(%s)'.format(table), (list(user_ids),))
+    cursor.execute('DELETE FROM users WHERE id = ANY(%s)', (list(user_ids),))
+    conn.commit()
+    conn.close()
+
+
+def wait_for_bot(api, process, timeout=60):
+    # The bot creates its tables before it starts polling, so the first getUpdates means it's ready
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if api.calls['getUpdates'] or api.calls['deleteWebhook']:
+            return
+        if process and process.poll() is not None:
+            raise SystemExit('bot.py exited with code {}'.format(process.returncode))
+        time.sleep(0.1)
+    raise SystemExit('bot.py did not start polling within {} seconds'.format(timeout))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float('nan')
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def report(api, elapsed):
+    all_latencies = sorted(latency for latencies in api.latencies.values() for latency in latencies)
+    replies = len(all_latencies)
+    timeouts = sum(api.timeouts.values())
+    throttled = sum(api.throttled.values())
+
+    print()
+    print('Measured for {:.1f}s'.format(elapsed))
+    print('Replies:     {}'.format(replies))
+    print('Timeouts:    {}'.format(timeouts))
+    print('Throttled:   {}'.format(throttled))
+    print('Throughput:  {:.1f} updates/sec'.format(replies / elapsed if elapsed else 0))
+    print('Latency:     p50 {:.0f}ms  p90 {:.0f}ms  p99 {:.0f}ms  max {:.0f}ms'.format(
+        percentile(all_latencies, 0.5) * 1000, percentile(all_latencies, 0.9) * 1000,
+        percentile(all_latencies, 0.99) * 1000, percentile(all_latencies, 1.0) * 1000))
+    print()
+    print('{:<20} {:>8} {:>8} {:>9} {:>10} {:>10} {:>10}'.format('command', 'replies', 'timeouts', 'throttled', 'p50 ms', 'p90 ms', 'p99 ms'))
+    for command in sorted(set(api.latencies) | set(api.timeouts) | set(api.throttled)):
+        latencies = sorted(api.latencies[command])
+        print('{:<20} {:>8} {:>8} {:>9} {:>10.0f} {:>10.0f} {:>10.0f}'.format(
+            command, len(latencies), api.timeouts[command], api.throttled[command], percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.9) * 1000, percentile(latencies, 0.99) * 1000))
+    print()
+    print('Bot API calls: ' + ', '.join('{} {}'.format(method, count) for method, count in sorted(api.calls.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the bot against a local fake Bot API server.')
+    parser.add_argument('--users', type=int, default=1000, help='number of simulated users')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to measure for')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds to run before measuring')
+    parser.add_argument('--think', type=float, default=0, help='mean seconds a user waits between a reply and their next command')
+    parser.add_argument('--reply-timeout', type=float, default=10, help='seconds before a command without reply counts as timed out')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='command=weight pairs, eg. meditate=5,top=1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--no-spawn', action='store_true', help="don't start bot.py, one is already pointed at the fake server")
+    parser.add_argument('--cleanup', action='store_true', help='delete the simulated users and their entries afterwards')
+    args = parser.parse_args()
+
+    commands, weights = parse_mix(args.mix)
+    user_ids = list(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+
+    api = FakeBotAPI(args.reply_timeout)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(api))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{}/bot'.format(args.port)
+    print('Fake Bot API listening on {}'.format(base_url))
+
+    process = None
+    if not args.no_spawn:
+        env = dict(UNLIMITED_ADMISSION, **os.environ)
+        env.update(BOT_TOKEN=FAKE_TOKEN, BOT_API_URL=base_url)
+        process = subprocess.Popen([sys.executable, 'bot.py'], cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+
+    try:
+        wait_for_bot(api, process)
+        seed_users(user_ids)
+        print('Bot is polling, {} users seeded. Warming up for {}s...'.format(args.users, args.warmup))
+
+        # (time the user sends their next command, user id)
+        schedule = deque((time.monotonic(), user_id) for user_id in user_ids)
+        started = time.monotonic()
+        measure_from = started + args.warmup
+        stop_at = measure_from + args.duration
+        while time.monotonic() < stop_at:
+            now = time.monotonic()
+            if not api.measuring and now >= measure_from:
+                api.measuring = True
+                print('Measuring for {}s...'.format(args.duration))
+
+            api.expire_in_flight()
+            for user_id in api.take_ready_users():
+                think = random.expovariate(1 / args.think) if args.think else 0
+                schedule.append((now + think, user_id))
+
+            waiting = deque()
+            while schedule:
+                send_at, user_id = schedule.popleft()
+                if send_at > now:
+                    waiting.append((send_at, user_id))
+                    continue
+                command = random.choices(commands, weights)[0]
+                api.push_command(user_id, command, COMMANDS[command]())
+            schedule = waiting
+            time.sleep(0.01)
+
+        report(api, time.monotonic() - measure_from)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+        server.shutdown()
+        if args.cleanup:
+            cleanup_users(user_ids)
+
+
+if __name__ == '__main__':
+    main()